@@ -9,6 +9,9 @@ class Audio:
         self.sampleRate = None
         self.channels = None
         self.bytesPerSample = None
+        # wav file the appended data goes to while streaming, see openStream
+        self.stream = None
+        self.streamSize = 0
         
     def loadConfig(self, sampleRate, channels, bytesPerSample):
         self.sampleRate = sampleRate
@@ -30,24 +33,48 @@ class Audio:
         assert bytesPerSample==2, "bytesPerSample should be 2"
         assert channels==self.channels, "channels mismatch"
         assert sampleRate==self.sampleRate, "sampleRate mismatch"
-        self.data = self.data + data
+        stream = self.stream
+        if stream is not None:
+            stream.write(data)
+            self.streamSize += len(data)
+            return
+        # extend in place, copying self.data every time makes a long recording quadratic
+        if not isinstance(self.data, bytearray):
+            self.data = bytearray(self.data)
+        self.data += data
+
+    def openStream(self, filepath):
+        # start a recording that appendData writes straight to filepath, memory use stays flat
+        assert self.initialized==True, "Audio not initialized"
+        assert self.stream is None, "Already streaming"
+        print("streaming with sr="+str(self.sampleRate)+" channels="+str(self.channels)+" to "+filepath)
+        self.stream = open(filepath, "wb")
+        self.streamSize = 0
+        # the sizes are patched when the stream is closed
+        self.writeHeader(self.stream, 0)
+
+    def closeStream(self):
+        assert self.stream is not None, "Not streaming"
+        try:
+            self.stream.seek(4)
+            self.stream.write(struct.pack('<I', 36+self.streamSize))    # 4-7    chunksize = datasize + 36
+            self.stream.seek(40)
+            self.stream.write(struct.pack('<I', self.streamSize))       # 40-43  datasize
+        finally:
+            self.stream.close()
+            self.stream = None
+        print("Stream closed after "+str(self.streamSize)+" bytes")
+        return 0
         
     def loadWaveForm(self, waveform, sampleRate, channels, bytesPerSample):
         assert bytesPerSample==2, "bytesPerSample should be 2"
         assert channels==1 or channels==2, "channels must be 1 or 2"
-        data = b''
-        
+        # 1.0 would be 32768, one more than int16 holds
+        samples = numpy.clip(numpy.round(numpy.asarray(waveform, dtype=numpy.float64)*32768), -32768, 32767).astype('<i2')
         if channels == 2:
-            for float in waveform:
-                b = struct.pack('h', round(float*32768))
-                data += b  # connect bytes
-                data += b  # 2 channels
-        elif channels == 1:
-            for float in waveform:
-                b = struct.pack('h', round(float*32768))
-                data += b  # connect bytes
+            samples = numpy.repeat(samples, 2)  # same sample on both channels
                     
-        self.data = data
+        self.data = samples.tobytes()
         self.sampleRate = sampleRate
         self.channels = channels
         self.bytesPerSample = bytesPerSample
@@ -58,15 +85,28 @@ class Audio:
         print("loadFrames with sr="+str(sampleRate)+" channels="+str(channels)+" frameSize="+str(len(frames[0])))
         assert bytesPerSample==2, "bytesPerSample should be 2"
         assert channels==1 or channels==2, "channels must be 1 or 2"
-        data = b''
-        for frame in frames:
-            data+= frame
-        self.data = data
+        self.data = b''.join(frames)
         self.sampleRate = sampleRate
         self.channels = channels
         self.bytesPerSample = bytesPerSample
         self.initialized = True
         return 0
+
+    def getSamples(self):
+        # int16 view of the data, one row per frame and one column per channel, without copying
+        frames = len(self.data) // (self.channels*self.bytesPerSample)
+        return numpy.frombuffer(self.data, dtype='<i2', count=frames*self.channels).reshape(frames, self.channels)
+
+    def convertChannels(self, channels, samples=None):
+        # int16 samples of the data, or of some rows of getSamples, in the given number of channels
+        if samples is None:
+            samples = self.getSamples()
+        if self.channels==2 and channels==1:
+            # average the two channels
+            return ((samples[:, 0].astype(numpy.int32) + samples[:, 1]) // 2).astype('<i2')
+        if self.channels==1 and channels==2:
+            return numpy.repeat(samples[:, 0] // 2, 2)
+        return samples.reshape(-1)
         
     def getData(self, sampleRate, channels, bytesPerSample):
         try:
@@ -74,23 +114,10 @@ class Audio:
             assert self.sampleRate==sampleRate, "sampleRate mismatch, resample first"
             assert channels==1 or channels==2, "Channels must be 1 or 2"
             assert self.bytesPerSample==2 and bytesPerSample==2, "bytesPerSample should be 2"
-            data = b''
             if self.channels==channels:
-                return self.data
-            elif self.channels==1 and channels==2:
-                for i in range(0, len(self.data), self.channels*bytesPerSample):
-                    num = struct.unpack('<h', self.data[i:i+bytesPerSample])[0]
-                    num = num // 2
-                    data += struct.pack('h', num)
-                    data += struct.pack('h', num)
-            elif self.channels==2 and channels==1:
-                for i in range(0, len(self.data), self.channels*bytesPerSample):
-                    num1 = struct.unpack('<h', self.data[i:i+bytesPerSample])[0]
-                    num2 = struct.unpack('<h', self.data[i+bytesPerSample:i+2*bytesPerSample])[0]
-                    num = (num1+num2)/2
-                    data += struct.pack('h', num)
-                
-            return data
+                # the data may be a bytearray being appended to or a memory map, always hand out bytes
+                return bytes(self.data)
+            return self.convertChannels(channels).tobytes()
         except Exception as e:
             print("Error during getData")
             print(e)
@@ -106,20 +133,8 @@ class Audio:
             assert self.sampleRate==sampleRate, "sampleRate mismatch, resample first"
             assert channels==1, "Channels of waveform must be 1"
             assert self.bytesPerSample==2 and bytesPerSample==2, "bytesPerSample should be 2"
-            waveform = []
-            if self.channels==1:
-                for i in range(0, len(self.data), self.channels*bytesPerSample):
-                    num1 = struct.unpack('<h', self.data[i:i+bytesPerSample])[0]
-                    waveform.append(num1/32768.0)
-                
-            elif self.channels==2:
-                for i in range(0, len(self.data), self.channels*bytesPerSample):
-                    num1 = struct.unpack('<h', self.data[i:i+bytesPerSample])[0]
-                    num2 = struct.unpack('<h', self.data[i+bytesPerSample:i+2*bytesPerSample])[0]
-                    waveform.append((num1+num2)/32768.0/2.0)    # resize to [-1, 1], average 2 channels
-            
-            waveform = numpy.array(waveform)
-            return waveform
+            # resize to [-1, 1], average 2 channels
+            return self.getSamples().sum(axis=1, dtype=numpy.float64) / (32768.0*self.channels)
         except Exception as e:
             print("Error during getWaveForm")
             print(e)
@@ -128,58 +143,38 @@ class Audio:
         #framesize, sampleRate, channels, bytesPerSample are what format you want
     def getFrames(self, sampleRate, channels, frameSize, bytesPerSample):
         try:
-            assert self.initialized==True, "Audio not initialized"
-            assert self.sampleRate==sampleRate, "sampleRate mismatch, resample first"
-            assert channels==1 or channels==2, "Channels must be 1 or 2"
-            assert self.bytesPerSample==2 and bytesPerSample==2, "bytesPerSample should be 2"
-            frames = []
-            if self.channels==channels:
-                length = len(self.data)
-                i=0
-                while True:
-                    if i+frameSize>=length:
-                        frames.append(self.data[i:])
-                        break
-                    frames.append(self.data[i:i+frameSize])
-                    i += frameSize
-            elif self.channels==2 and channels==1:
-                #raise Exception("self.channels==2 and channels==1")
-                frameIndex = 0
-                frame=b''
-                for i in range(0, len(self.data), 2*bytesPerSample):
-                    num1 = struct.unpack('<h', self.data[i:i+bytesPerSample])[0]
-                    num2 = struct.unpack('<h', self.data[i+bytesPerSample:i+2*bytesPerSample])[0]
-                    num = (num1+num2)/2
-                    frame += struct.pack('h', num)
-                    frameIndex += bytesPerSample
-                    if frameIndex == frameSize:
-                        frames.append(frame)
-                        frame = b''
-                        frameIndex = 0
-                if len(frame)>0:
-                    frames.append(frame)
-            elif self.channels==1 and channels==2:
-                #raise Exception("self.channels==1 and channels==2")
-                assert frameSize%2==0, "frameSize is odd number"
-                frameIndex = 0
-                frame=b''
-                for i in range(0, len(self.data), bytesPerSample):
-                    num = struct.unpack('<h', self.data[i:i+bytesPerSample])[0]
-                    frame += struct.pack('h', num)
-                    frame += struct.pack('h', num)
-                    frameIndex += 2*bytesPerSample
-                    if frameIndex == frameSize:
-                        frames.append(frame)
-                        frame = b''
-                        frameIndex = 0
-                if len(frame)>0:
-                    frames.append(frame)
-                    
-            return frames
+            return list(self.iterFrames(sampleRate, channels, frameSize, bytesPerSample))
         except Exception as e:
             print("Error during getFrames")
             print(e)
             return 1
+
+        #same frames as getFrames, converted a block at a time, so a memory mapped file is never loaded whole
+    def iterFrames(self, sampleRate, channels, frameSize, bytesPerSample):
+        assert self.initialized==True, "Audio not initialized"
+        assert self.sampleRate==sampleRate, "sampleRate mismatch, resample first"
+        assert channels==1 or channels==2, "Channels must be 1 or 2"
+        assert self.bytesPerSample==2 and bytesPerSample==2, "bytesPerSample should be 2"
+        if self.channels==channels:
+            # an empty recording is one empty frame
+            for i in range(0, max(len(self.data), 1), frameSize):
+                yield bytes(self.data[i:i+frameSize])
+            return
+        if self.channels==1 and channels==2:
+            assert frameSize%2==0, "frameSize is odd number"
+        samples = self.getSamples()
+        # a block is a whole number of frames made of whole converted samples
+        blockSize = 4*frameSize*max(1, 16384//frameSize)
+        blockRows = blockSize//(channels*bytesPerSample)
+        for start in range(0, len(samples), blockRows):
+            block = samples[start:start+blockRows]
+            if channels==2:
+                # unlike getData, the frames keep the full level on both channels
+                data = numpy.repeat(block[:, 0], 2).tobytes()
+            else:
+                data = self.convertChannels(channels, block).tobytes()
+            for i in range(0, len(data), frameSize):
+                yield data[i:i+frameSize]
     
     def write(self, filepath):
         assert self.initialized==True, "Audio not initialized"
@@ -190,24 +185,7 @@ class Audio:
         try:
             file = open(filepath, "wb")
             
-            datasize = len(self.data)
-            
-            file.write("RIFF".encode())                     # 0-3    RIFF
-            file.write(struct.pack('i', 36+datasize))       # 4-7    chunksize = datasize + 36
-            file.write("WAVEfmt ".encode())                 # 8-15   WAVEfmt(SPACE)
-            file.write(struct.pack('i', 16))                # 16-19  SubchunkSize = 16
-            file.write(struct.pack('h', 1))                 # 20-21  AudioFormat = 1
-            file.write(struct.pack('h', self.channels))     # 22-23  NumOfChannels always 2
-            file.write(struct.pack('i', self.sampleRate))   # 24-27  SampleRate
-            byte_rate = self.sampleRate * self.channels * self.bytesPerSample
-            file.write(struct.pack('i', byte_rate))         # 28-31  ByteRate
-            block_align = 2 * self.bytesPerSample
-            file.write(struct.pack('h', block_align))       # 32-33  BlockAlign
-            bits_per_sample = self.bytesPerSample * 8
-            file.write(struct.pack('h', bits_per_sample))   # 34-35  BitsPerSample
-            file.write("data".encode())                     # 36-39  data
-            file.write(struct.pack('i', datasize))          # 40-43  datasize
-            
+            self.writeHeader(file, len(self.data))
             file.write(self.data)
             
             file.close()
@@ -224,33 +202,66 @@ class Audio:
             return 1
 
 
-    def read(self, filepath):
+    def writeHeader(self, file, datasize):
+        file.write("RIFF".encode())                     # 0-3    RIFF
+        file.write(struct.pack('<I', 36+datasize))      # 4-7    chunksize = datasize + 36
+        file.write("WAVEfmt ".encode())                 # 8-15   WAVEfmt(SPACE)
+        file.write(struct.pack('<i', 16))               # 16-19  SubchunkSize = 16
+        file.write(struct.pack('<h', 1))                # 20-21  AudioFormat = 1
+        file.write(struct.pack('<h', self.channels))    # 22-23  NumOfChannels
+        file.write(struct.pack('<i', self.sampleRate))  # 24-27  SampleRate
+        byte_rate = self.sampleRate * self.channels * self.bytesPerSample
+        file.write(struct.pack('<i', byte_rate))        # 28-31  ByteRate
+        block_align = self.channels * self.bytesPerSample
+        file.write(struct.pack('<h', block_align))      # 32-33  BlockAlign
+        bits_per_sample = self.bytesPerSample * 8
+        file.write(struct.pack('<h', bits_per_sample))  # 34-35  BitsPerSample
+        file.write("data".encode())                     # 36-39  data
+        file.write(struct.pack('<I', datasize))         # 40-43  datasize
+
+    def read(self, filepath, lazy=False):
+        # walk the chunks of the file, the ones other than fmt and data (LIST, fact...) are skipped
+        # with lazy, the data is a read-only memory map of the file and is only read when used
         try:
-            file = open(filepath, "rb")
-            
-            assert str(file.read(4), encoding='utf-8')=="RIFF", "File does not start with RIFF"         # 0-3    RIFF
-            chunkSize = int.from_bytes(file.read(4), "little")                                          # 4-7    chunksize = datasize + 36
-            assert str(file.read(8), encoding='utf-8')=="WAVEfmt ", "File has incorrect WAVEfmt part"   # 8-15   WAVEfmt(SPACE)
-            assert int.from_bytes(file.read(4), "little")==16, "SubchunkSize is not 16"                 # 16-19  SubchunkSize = 16
-            assert int.from_bytes(file.read(2), "little")==1, "AudioFormat is not 1"                    # 20-21  AudioFormat = 1
-            channels = int.from_bytes(file.read(2), "little")                                           # 22-23  NumOfChannels
-            assert channels==2 or channels==1, "channels must be 1 or 2"
-            sampleRate = int.from_bytes(file.read(4), "little")                                        # 24-27  SampleRate
-            ByteRate = int.from_bytes(file.read(4), "little")                                           # 28-31  ByteRate
-            BlockAlign = int.from_bytes(file.read(2), "little")                                         # 32-33  BlockAlign
-            BitsPerSample = int.from_bytes(file.read(2), "little")                                      # 34-35  BitsPerSample
-            assert BitsPerSample==16, "Can't handle BitsPerSample != 16"
-            assert str(file.read(4), encoding='utf-8')=="data", "\"data\" header incorrect"             # 36-39  data
-            datasize = int.from_bytes(file.read(4), "little")                                           # 40-43  datasize
+            with open(filepath, "rb") as file:
+                filesize = os.fstat(file.fileno()).st_size
+                assert file.read(4)==b"RIFF", "File does not start with RIFF"                           # 0-3    RIFF
+                file.read(4)                                                                            # 4-7    chunksize
+                assert file.read(4)==b"WAVE", "File is not WAVE"                                        # 8-11   WAVE
+                channels = None
+                datasize = None
+                while True:
+                    header = file.read(8)
+                    if len(header) < 8:
+                        break
+                    chunkId = header[:4]
+                    size = int.from_bytes(header[4:], "little")
+                    if chunkId == b"fmt ":
+                        assert size >= 16, "fmt chunk too short"
+                        AudioFormat, channels, sampleRate, ByteRate, BlockAlign, BitsPerSample = struct.unpack('<hhiihh', file.read(16))
+                        assert AudioFormat==1, "AudioFormat is not 1"
+                        file.seek(size - 16 + (size & 1), 1)
+                    elif chunkId == b"data":
+                        offset = file.tell()
+                        # a recording that was not closed has a data size of 0, it goes to the end of the file
+                        datasize = size if size != 0 and offset + size <= filesize else filesize - offset
+                        break
+                    else:
+                        # chunks are padded to an even size
+                        file.seek(size + (size & 1), 1)
+                assert channels is not None, "No fmt chunk"
+                assert datasize is not None, "No data chunk"
+                assert channels==2 or channels==1, "channels must be 1 or 2"
+                assert BitsPerSample==16, "Can't handle BitsPerSample != 16"
+                bytesPerSample = BitsPerSample//8
+                assert ByteRate == channels*sampleRate*bytesPerSample, "Incorrect ByteRate"
+                assert BlockAlign == channels*bytesPerSample, "Incorrect BlockAlign"
 
-            bytesPerSample = BitsPerSample//8
-            assert ByteRate == channels*sampleRate*bytesPerSample, "Incorrect ByteRate"
-            assert BlockAlign == channels*bytesPerSample, "Incorrect BlockAlign"
-            assert chunkSize == datasize + 36, "Incorrect chunksize or datasize"
+                if lazy and datasize > 0:
+                    data = numpy.memmap(filepath, dtype=numpy.uint8, mode='r', offset=offset, shape=(datasize,))
+                else:
+                    data = file.read(datasize)
             
-            data = file.read(datasize)
-            
-            file.close()
             print("Read success")
             self.initialized = True
             self.data = data
@@ -263,4 +274,3 @@ class Audio:
             print("Error during read")
             print(e)
             return 1
-        
\ No newline at end of file
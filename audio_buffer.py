@@ -0,0 +1,280 @@
+import numpy as np
+from typing import Dict, Optional, Tuple
+
+
+class AudioRingBuffer:
+    """
+    Bounded ring buffer of int16 samples backed by a preallocated NumPy array.
+    When the buffer is full, the oldest samples are dropped to make room for the new ones.
+    """
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self.data = np.zeros(capacity, dtype=np.int16)
+        self.start = 0
+        self.size = 0
+        # number of samples dropped because the buffer was full
+        self.dropped = 0
+
+    def __len__(self):
+        return self.size
+
+    def write(self, samples: np.ndarray):
+        n = len(samples)
+        if n >= self.capacity:
+            # only the newest samples fit
+            self.dropped += self.size + n - self.capacity
+            self.data[:] = samples[n - self.capacity:]
+            self.start = 0
+            self.size = self.capacity
+            return
+        overflow = self.size + n - self.capacity
+        if overflow > 0:
+            self.consume(overflow)
+            self.dropped += overflow
+        end = (self.start + self.size) % self.capacity
+        first = min(n, self.capacity - end)
+        self.data[end:end + first] = samples[:first]
+        self.data[:n - first] = samples[first:]
+        self.size += n
+
+    def write_bytes(self, data: bytes):
+        self.write(np.frombuffer(data, dtype=np.int16))
+
+    def write_silence(self, n: int):
+        self.write(np.zeros(n, dtype=np.int16))
+
+    def peek(self, n: int) -> np.ndarray:
+        # return up to n of the oldest samples without consuming them
+        # this is a view into the buffer when the samples do not wrap around, so it is only
+        # valid until the next write
+        n = min(n, self.size)
+        if self.start + n <= self.capacity:
+            return self.data[self.start:self.start + n]
+        return np.concatenate((self.data[self.start:], self.data[:self.start + n - self.capacity]))
+
+    def read(self, n: int) -> np.ndarray:
+        # same as peek, but the samples are consumed
+        samples = self.peek(n)
+        self.consume(len(samples))
+        return samples
+
+    def consume(self, n: int):
+        # drop up to n of the oldest samples in O(1)
+        n = min(n, self.size)
+        self.start = (self.start + n) % self.capacity
+        self.size -= n
+
+    def trim(self, n: int):
+        # keep only the newest n samples in O(1)
+        if self.size > n:
+            self.consume(self.size - n)
+
+    def clear(self):
+        self.start = 0
+        self.size = 0
+
+
+class JitterBuffer:
+    """
+    Adaptive jitter buffer for one audio stream. It tracks the jitter of the packet arrivals,
+    sizes its target depth from that measurement and plays slightly faster or slower to
+    converge to the target, so the latency stays near the jitter of the network. With drift control,
+    the rate follows the smoothed depth in proportion to its excess, so it also takes up the drift
+    between the clocks of the sender and the player. With concealment, up to that many missing chunks
+    are replaced by the last chunk fading out. A drift margin, as a fraction of a chunk, keeps that much
+    audio above the target, so a sender with a slower clock is slowed down before the buffer runs dry,
+    at the cost of as much latency.
+    """
+    def __init__(self, chunk_samples: int, chunk_duration: float, min_depth: int = 1, max_depth: int = 4,
+                 stretch: float = 0.02, concealment: int = 0, drift_margin: float = 0.0,
+                 drift_control: bool = False):
+        self.chunk_samples = chunk_samples
+        self.chunk_duration = chunk_duration
+        # bounds of the target depth in samples
+        self.min_depth = min_depth * chunk_samples
+        self.max_depth = max_depth * chunk_samples
+        # leave some room above the max depth so that speeding up can catch up before samples are dropped
+        self.buffer = AudioRingBuffer(2 * self.max_depth)
+        self.target_depth = self.min_depth
+        self.drift_margin = int(drift_margin * chunk_samples)
+        # smoothed deviation of the inter-arrival times from the packet duration, in seconds
+        self.jitter = 0.0
+        self.last_arrival = None
+        # False while the buffer (re)fills up to the target depth after an underrun
+        self.playing = False
+        # True while the sender is silent and sends nothing, see pause
+        self.paused = False
+        self.underruns = 0
+        # chunks played out without being read since the last put or get, see skip
+        self.skipped = 0
+        self.drift_control = drift_control
+        # depth averaged over the last chunks played, in samples
+        self.average_depth = 0.0
+
+        # read a little more or a little less than one chunk and resample it to one chunk to play
+        # faster or slower, by at most max_adjustment samples per chunk
+        self.max_adjustment = max(1, int(chunk_samples * stretch))
+        # sample positions of the resampling for each size read, computed once
+        self.resampling: Dict[int, Tuple[np.ndarray, np.ndarray]] = {}
+
+        self.concealment = concealment
+        # number of chunks concealed in a row, and True while the stream has a gap to conceal
+        self.concealed = 0
+        self.gap = False
+        self.last_played: Optional[np.ndarray] = None
+        self.last_received: Optional[np.ndarray] = None
+        # every concealed chunk fades out by half, and the audio after a gap fades in
+        self.fade_out = (0.5 ** (np.arange(chunk_samples) / chunk_samples)).astype(np.float32)
+        self.fade_in = np.linspace(0, 1, min(chunk_samples, 64), dtype=np.float32)
+
+    def __len__(self):
+        return len(self.buffer) - self.skipped * self.chunk_samples
+
+    def put(self, samples: np.ndarray, arrival_time: float):
+        self.settle()
+        if self.last_arrival is not None:
+            # running estimate of the interarrival jitter, the same filter as RTP (RFC 3550)
+            packet_duration = len(samples) / self.chunk_samples * self.chunk_duration
+            deviation = abs(arrival_time - self.last_arrival - packet_duration)
+            self.jitter += (deviation - self.jitter) / 16
+        self.last_arrival = arrival_time
+        self.last_received = samples
+        if self.paused:
+            # start of a talk spurt, fill up to the target depth again before playing
+            self.paused = False
+            self.playing = False
+        self.buffer.write(samples)
+
+        # keep enough audio to ride out a few times the measured jitter
+        jitter_samples = int(4 * self.jitter / self.chunk_duration * self.chunk_samples)
+        target = self.chunk_samples + self.drift_margin + jitter_samples
+        self.target_depth = min(self.max_depth, max(self.min_depth, target))
+
+    def ready(self) -> bool:
+        # True if a chunk can be played now, the mixer asks every stream at every tick so the depth is
+        # read straight from the ring
+        depth = self.buffer.size - self.skipped * self.chunk_samples
+        if self.playing or self.paused:
+            return depth >= self.chunk_samples
+        return depth >= self.target_depth and depth >= self.chunk_samples
+
+    def next_size(self) -> Optional[int]:
+        # number of buffered samples the next chunk is made of, or None if the stream has nothing to play
+        self.settle()
+        if not self.ready():
+            if self.playing and not self.paused:
+                self.underruns += 1
+                self.gap = True
+            self.playing = False
+            return None
+        if not self.playing:
+            self.average_depth = len(self.buffer)
+        self.playing = True
+
+        if not self.drift_control:
+            excess = len(self.buffer) - self.target_depth
+            if excess > self.chunk_samples // 2 and len(self.buffer) >= self.chunk_samples + self.max_adjustment:
+                # too much audio buffered, play a bit faster
+                return self.chunk_samples + self.max_adjustment
+            if excess < -(self.chunk_samples // 2):
+                # running low, play a bit slower
+                return self.chunk_samples - self.max_adjustment
+            return self.chunk_samples
+
+        # the excess of a single packet is jitter, a lasting one is drift
+        self.average_depth += (len(self.buffer) - self.average_depth) / 8
+        excess = self.average_depth - self.target_depth
+        if abs(excess) < self.chunk_samples // 8:
+            return self.chunk_samples
+        # too much audio buffered, play a bit faster, running low, play a bit slower
+        adjustment = int(np.clip(excess / 32, -self.max_adjustment, self.max_adjustment))
+        return min(self.chunk_samples + adjustment, len(self.buffer))
+
+    def get(self) -> Optional[np.ndarray]:
+        # return the next chunk to play, or None if the stream has nothing to play
+        n = self.next_size()
+        if n is None:
+            return self.conceal()
+        samples = self.buffer.read(n)
+        if n != self.chunk_samples:
+            if n not in self.resampling:
+                self.resampling[n] = (np.linspace(0, n - 1, self.chunk_samples), np.arange(n))
+            positions, grid = self.resampling[n]
+            samples = np.interp(positions, grid, samples).astype(np.int16)
+        if self.concealed > 0:
+            # back from a gap, do not jump from the faded concealment to full level
+            samples = samples.copy()
+            samples[:len(self.fade_in)] = samples[:len(self.fade_in)] * self.fade_in
+        self.concealed = 0
+        self.gap = False
+        if self.concealment > 0:
+            self.last_played = samples
+        return samples
+
+    def faded(self, samples: np.ndarray, k: int) -> np.ndarray:
+        # the k-th chunk of concealment made from samples
+        return (samples * (self.fade_out[:len(samples)] * 0.5 ** k)).astype(np.int16)
+
+    def conceal(self) -> Optional[np.ndarray]:
+        # a chunk to play in place of the audio that did not arrive in time, None once the gap is too long
+        if not self.gap or self.concealed >= self.concealment or self.last_played is None:
+            return None
+        samples = self.faded(self.last_played, self.concealed)
+        self.concealed += 1
+        return samples
+
+    def put_lost(self, n_chunks: int):
+        # frames lost on the way, concealment takes their place so the audio after them keeps its timing
+        if self.last_received is None or self.paused:
+            return
+        self.settle()
+        for k in range(min(n_chunks, self.concealment)):
+            self.buffer.write(self.faded(self.last_received, k))
+        if self.last_arrival is not None:
+            # the lost frames are not late, only the next one may be
+            self.last_arrival += n_chunks * self.chunk_duration
+
+    def skip(self):
+        # play out the next chunk without reading it, for a stream that is not mixed this tick
+        # it is only counted, so a stream that is not mixed costs next to nothing per tick
+        if self.ready():
+            self.playing = True
+            self.skipped += 1
+        else:
+            # the underrun is recorded like get would
+            self.next_size()
+
+    def settle(self):
+        # drop the skipped chunks at once
+        if self.skipped == 0:
+            return
+        n = self.skipped * self.chunk_samples
+        # the depth the last skipped chunk was played from, what next_size keeps near the target
+        excess = len(self.buffer) - n + self.chunk_samples - self.target_depth
+        # as fast or slow as next_size would have played them, until the depth is within half a chunk
+        limit = self.skipped * self.max_adjustment
+        if excess > self.chunk_samples // 2:
+            n += min(limit, excess - self.chunk_samples // 2)
+        elif excess < -(self.chunk_samples // 2):
+            n -= min(limit, -(self.chunk_samples // 2) - excess)
+        self.buffer.consume(n)
+        self.skipped = 0
+
+    def pause(self):
+        # the sender stopped sending until its next talk spurt, the buffered audio is still played out
+        # and the gap is neither jitter nor an underrun
+        self.paused = True
+        self.last_arrival = None
+        self.gap = False
+
+    def reset(self):
+        # drop the buffered audio, the jitter estimate is kept
+        self.buffer.clear()
+        self.skipped = 0
+        self.playing = False
+        self.paused = False
+        self.last_arrival = None
+        self.gap = False
+        self.concealed = 0
+        self.last_played = None
+        self.last_received = None
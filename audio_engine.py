@@ -0,0 +1,198 @@
+import asyncio
+import numpy as np
+import pyaudio
+
+
+class RingBuffer:
+    """
+    Preallocated ring of samples between one producer thread and one consumer thread. The producer
+    only moves written and the consumer only moves consumed, each after copying the samples, so
+    neither side takes a lock and the PyAudio callbacks never wait on the event loop. A producer
+    that must not wait uses overwrite, which replaces the oldest unread samples when the ring is
+    full, and the consumer skips whatever was overwritten, even while it was copying it.
+    """
+    def __init__(self, capacity: int, dtype=np.int16):
+        self.buffer = np.zeros(capacity, dtype=dtype)
+        self.capacity = capacity
+        # total number of samples written and read since the start
+        self.written = 0
+        self.consumed = 0
+        # written plus the samples being copied by overwrite, which may already be replacing unread ones
+        self.reserved = 0
+
+    def __len__(self):
+        return min(self.written - self.consumed, self.capacity)
+
+    def free(self) -> int:
+        return self.capacity - len(self)
+
+    def write(self, samples: np.ndarray) -> int:
+        # copy as many samples as fit, return how many
+        n = min(len(samples), self.free())
+        start = self.written % self.capacity
+        first = min(n, self.capacity - start)
+        self.buffer[start:start + first] = samples[:first]
+        self.buffer[:n - first] = samples[first:n]
+        self.written += n
+        return n
+
+    def overwrite(self, samples: np.ndarray) -> int:
+        # copy all the samples, the oldest unread ones make room if needed, return how many were lost
+        samples = samples[-self.capacity:]
+        n = len(samples)
+        lost = max(0, n - self.free())
+        self.reserved = self.written + n
+        start = self.written % self.capacity
+        first = min(n, self.capacity - start)
+        self.buffer[start:start + first] = samples[:first]
+        self.buffer[:n - first] = samples[first:]
+        self.written += n
+        return lost
+
+    def read_into(self, out: np.ndarray) -> int:
+        # fill out with the oldest samples still in the ring, return how many there were
+        while True:
+            consumed = max(self.consumed, self.written - self.capacity)
+            n = min(len(out), self.written - consumed)
+            start = consumed % self.capacity
+            first = min(n, self.capacity - start)
+            out[:first] = self.buffer[start:start + first]
+            out[first:n] = self.buffer[:n - first]
+            if self.reserved - self.capacity <= consumed:
+                # nothing was overwritten during the copy
+                break
+        self.consumed = consumed + n
+        return n
+
+    def discard(self):
+        # drop every sample written so far, on the consumer side
+        self.consumed = self.written
+
+
+class BlockingAudioEngine:
+    """
+    Blocking PyAudio streams, every read and write of a chunk runs in the default executor.
+    """
+    def __init__(self, pyaudio_instance, audio_format, channels: int, rate: int, chunk_size: int):
+        self.chunk_size = chunk_size
+        self.record_stream = pyaudio_instance.open(
+            format=audio_format, channels=channels, rate=rate, input=True, frames_per_buffer=chunk_size
+        )
+        self.play_stream = pyaudio_instance.open(
+            format=audio_format, channels=channels, rate=rate, output=True, frames_per_buffer=chunk_size
+        )
+
+    async def read(self) -> np.ndarray:
+        # the next chunk of captured int16 samples
+        loop = asyncio.get_event_loop()
+        data = await loop.run_in_executor(None, self.record_stream.read, self.chunk_size, False)
+        return np.frombuffer(data, dtype=np.int16)
+
+    async def write(self, samples: np.ndarray):
+        loop = asyncio.get_event_loop()
+        await loop.run_in_executor(None, self.play_stream.write, samples.tobytes())
+
+    def flush(self):
+        # drop the audio captured but not read yet
+        available = self.record_stream.get_read_available()
+        if available > 0:
+            self.record_stream.read(available, exception_on_overflow=False)
+
+    def close(self):
+        for stream in (self.record_stream, self.play_stream):
+            stream.stop_stream()
+            stream.close()
+
+
+class CallbackAudioEngine:
+    """
+    Callback-mode PyAudio streams. The capture callback copies the microphone into a ring buffer and
+    the playback callback takes what to play from another one, so the audio thread of PortAudio
+    never waits on the event loop and the loop never hands a chunk to a thread pool. The capture ring
+    drops its oldest audio when the loop falls behind. The loop side waits on an event that the
+    callbacks only set when it is waiting. The callbacks run every period_frames frames, the
+    playback ring holds playout_chunks chunks at most.
+    """
+    def __init__(self, pyaudio_instance, audio_format, channels: int, rate: int, chunk_size: int,
+                 period_frames: int = 512, playout_chunks: int = 2, capture_chunks: int = 4):
+        self.chunk_samples = chunk_size * channels
+        self.channels = channels
+        self.capture = RingBuffer(capture_chunks * self.chunk_samples)
+        self.playout = RingBuffer(playout_chunks * self.chunk_samples)
+        self.loop = asyncio.get_event_loop()
+        self.captured = asyncio.Event()
+        self.played = asyncio.Event()
+        self.capture_waiting = False
+        self.playout_waiting = False
+        self.period = np.zeros(period_frames * channels, dtype=np.int16)
+        # callbacks that had to drop captured audio or play silence for lack of audio
+        self.overruns = 0
+        self.underruns = 0
+        self.record_stream = pyaudio_instance.open(
+            format=audio_format, channels=channels, rate=rate, input=True,
+            frames_per_buffer=period_frames, stream_callback=self.on_capture
+        )
+        self.play_stream = pyaudio_instance.open(
+            format=audio_format, channels=channels, rate=rate, output=True,
+            frames_per_buffer=period_frames, stream_callback=self.on_playback
+        )
+
+    def on_capture(self, in_data, frame_count, time_info, status):
+        # audio thread of PortAudio
+        samples = np.frombuffer(in_data, dtype=np.int16)
+        # the loop fell behind, the oldest audio goes so that the capture latency stays bounded
+        if self.capture.overwrite(samples) > 0:
+            self.overruns += 1
+        if self.capture_waiting and len(self.capture) >= self.chunk_samples:
+            self.capture_waiting = False
+            self.loop.call_soon_threadsafe(self.captured.set)
+        return None, pyaudio.paContinue
+
+    def on_playback(self, in_data, frame_count, time_info, status):
+        # audio thread of PortAudio
+        n = frame_count * self.channels
+        if len(self.period) < n:
+            self.period = np.zeros(n, dtype=np.int16)
+        out = self.period[:n]
+        count = self.playout.read_into(out)
+        if count < n:
+            # nothing more to play, pad with silence
+            out[count:] = 0
+            self.underruns += 1
+        if self.playout_waiting and self.playout.free() >= self.chunk_samples:
+            self.playout_waiting = False
+            self.loop.call_soon_threadsafe(self.played.set)
+        return out.tobytes(), pyaudio.paContinue
+
+    async def read(self) -> np.ndarray:
+        # the next chunk of captured int16 samples, waits until the microphone has delivered it
+        while len(self.capture) < self.chunk_samples:
+            self.captured.clear()
+            self.capture_waiting = True
+            # the callback may have run before it could see that we wait
+            if len(self.capture) >= self.chunk_samples:
+                break
+            await self.captured.wait()
+        samples = np.empty(self.chunk_samples, dtype=np.int16)
+        self.capture.read_into(samples)
+        return samples
+
+    async def write(self, samples: np.ndarray):
+        # queue a chunk to play, waits while the playback ring is full so the caller is paced by the speaker
+        while self.playout.free() < len(samples):
+            self.played.clear()
+            self.playout_waiting = True
+            if self.playout.free() >= len(samples):
+                break
+            await self.played.wait()
+        self.playout.write(samples)
+
+    def flush(self):
+        # drop the audio captured but not read yet
+        self.capture.discard()
+
+    def close(self):
+        for stream in (self.record_stream, self.play_stream):
+            stream.stop_stream()
+            stream.close()
+        print(f"audio engine: {self.overruns} capture overruns, {self.underruns} playback underruns")
@@ -0,0 +1,255 @@
+"""
+Benchmarks of the audio paths of the server and the client. Run one of them with
+
+    python benchmark.py loop    # event loop latency while rooms are mixed, with and without the mixing executor
+    python benchmark.py topk    # cost of a tick when mixing everyone and only the k loudest, at 10, 50 and 200 clients
+    python benchmark.py pitch   # time to pitch shift a chunk, with the old per-sample loop and the streaming engine
+    python benchmark.py wav     # channel conversion and waveform paths of ReadWrite.Audio, per-sample loops and NumPy
+"""
+import argparse
+import asyncio
+import math
+import struct
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+import ReadWrite
+from audio_buffer import JitterBuffer
+from codec import CODECS
+from config import config
+from mixer import ActiveSpeakerSelector, MixMinusEngine
+from pitch_shift import PitchShifter
+
+
+def random_chunks(n_clients: int, chunk_samples: int) -> np.ndarray:
+    return np.random.randint(-3000, 3000, (n_clients, chunk_samples), dtype=np.int16)
+
+
+async def probe_loop_latency(duration: float, interval: float = 0.001):
+    # how late a task that wants to run every interval seconds is woken up
+    loop = asyncio.get_running_loop()
+    lags = []
+    end = loop.time() + duration
+    while loop.time() < end:
+        before = loop.time()
+        await asyncio.sleep(interval)
+        lags.append(loop.time() - before - interval)
+    return np.array(lags)
+
+
+async def mix_room(n_clients: int, executor, stop: asyncio.Event):
+    # the mixing part of ChatServer.mix_and_broadcast, one tick every chunk_duration
+    loop = asyncio.get_running_loop()
+    chunk_samples = config['chunk_size'] * config['channel']
+    chunk_duration = config['chunk_size'] / config['rate']
+    engine = MixMinusEngine(chunk_samples, config['amplification_factor'])
+    chunks = random_chunks(n_clients, chunk_samples)
+    deadline = loop.time()
+    while not stop.is_set():
+        engine.reset()
+        for chunk in chunks:
+            engine.load(chunk)
+        if executor is not None:
+            await loop.run_in_executor(executor, engine.mix)
+        else:
+            engine.mix()
+        deadline += chunk_duration
+        await asyncio.sleep(max(0.0, deadline - loop.time()))
+
+
+async def loop_latency(n_rooms: int, n_clients: int, executor, duration: float):
+    stop = asyncio.Event()
+    rooms = [asyncio.create_task(mix_room(n_clients, executor, stop)) for _ in range(n_rooms)]
+    lags = await probe_loop_latency(duration)
+    stop.set()
+    await asyncio.gather(*rooms)
+    return lags
+
+
+def benchmark_loop(args):
+    print(f'{args.rooms} rooms of {args.clients} clients, {args.duration} s each')
+    for name, executor in (('on the loop', None), ('in executor', ThreadPoolExecutor(config['mix_threads']))):
+        lags = asyncio.run(loop_latency(args.rooms, args.clients, executor, args.duration)) * 1000
+        print(f'{name}:\tloop lag mean {lags.mean():.3f} ms, p99 {np.percentile(lags, 99):.3f} ms, max {lags.max():.3f} ms')
+        if executor is not None:
+            executor.shutdown()
+
+
+def mix_tick(engine: MixMinusEngine, buffers, selector, codec):
+    # the mixing part of one tick of ChatServer.mix_and_broadcast, every listener encoded with the same codec
+    engine.reset()
+    mixed = []
+    selected = selector.select([key for key, buffer in buffers.items() if buffer.ready()]) if selector is not None else None
+    for key, buffer in buffers.items():
+        if selected is not None and key not in selected:
+            buffer.skip()
+            continue
+        samples = buffer.get()
+        if samples is None:
+            # still filling up
+            continue
+        engine.load(samples)
+        mixed.append(key)
+    rows, silent = engine.mix_rows()
+    # the full mix and one mix-minus row per mixed client, the other listeners share the full mix
+    codec.encode_rows(rows[:len(mixed) + 1])
+
+
+def benchmark_topk(args):
+    chunk_samples = config['chunk_size'] * config['channel']
+    chunk_duration = config['chunk_size'] / config['rate']
+    codec = CODECS[config['codecs'][0]]
+    ticks = 100
+    print(f'{ticks} ticks, {codec.name} codec, k = {args.k}')
+    for n_clients in (10, 50, 200):
+        # a few speakers and a room of background noise
+        levels = np.where(np.arange(n_clients) < 3, 3000, 100)
+        chunks = (random_chunks(n_clients, chunk_samples) * (levels[:, None] / 3000)).astype(np.int16)
+        for name, k in (('all', None), (f'top {args.k}', args.k)):
+            engine = MixMinusEngine(chunk_samples, config['amplification_factor'])
+            selector = ActiveSpeakerSelector(k) if k else None
+            buffers = {i: JitterBuffer(chunk_samples, chunk_duration) for i in range(n_clients)}
+            elapsed = 0.0
+            for _ in range(ticks):
+                for i, buffer in buffers.items():
+                    buffer.put(chunks[i], 0.0)
+                    if selector is not None:
+                        selector.update(i, chunks[i])
+                start = time.perf_counter()
+                mix_tick(engine, buffers, selector, codec)
+                elapsed += time.perf_counter() - start
+            print(f'{n_clients} clients, {name}:\t{elapsed / ticks * 1000:.3f} ms per tick')
+
+
+def loop_pitch_shift(frames: np.ndarray, n_steps: float) -> np.ndarray:
+    # the overlap-add of the former AudioChatClientGUI.change_speed and the resampling of change_pitch
+    speed = 1 / (2 ** (n_steps / 12))
+    new_length = int(len(frames) / speed)
+    new_arr = np.zeros(new_length, dtype=np.float32)
+    win_size = 1024
+    hs = win_size // 2
+    ha = int(speed * hs)
+    hanning_window = [0] * win_size
+    for i in range(win_size):
+        hanning_window[i] = 0.5 - 0.5 * math.cos(2 * math.pi * i / (win_size - 1))
+    old_pos = 0
+    new_pos = 0
+    while old_pos < len(frames) - win_size and new_pos < new_length - win_size:
+        for i in range(win_size):
+            new_arr[new_pos + i] += frames[old_pos + i] * hanning_window[i]
+        new_pos += hs
+        old_pos += ha
+    return np.interp(np.arange(0, new_length, 2 ** (n_steps / 12)), np.arange(new_length), new_arr)
+
+
+def benchmark_pitch(args):
+    chunk_size = config['chunk_size']
+    chunk_duration = chunk_size / config['rate']
+    t = np.arange(chunk_size * 50) / config['rate']
+    voice = (8000 * np.sin(2 * np.pi * 220 * t)).astype(np.int16)
+    chunks = voice.reshape(-1, chunk_size)
+    print(f'{len(chunks)} chunks of {chunk_size} samples, {chunk_duration * 1000:.1f} ms of audio each')
+    for n_steps in (-10, -4, 4, 10):
+        # the old loop shifted the previous and the current chunk together
+        start = time.perf_counter()
+        for chunk in chunks[:5]:
+            loop_pitch_shift(np.concatenate((chunk, chunk)).astype(np.float32) / 32767, n_steps)
+        loop_time = (time.perf_counter() - start) / 5
+        shifter = PitchShifter(max_steps=10)
+        shifter.set_steps(n_steps)
+        start = time.perf_counter()
+        for chunk in chunks:
+            shifter.process(chunk)
+        engine_time = (time.perf_counter() - start) / len(chunks)
+        print(f'{n_steps:+d} steps:\tloop {loop_time * 1000:.2f} ms, engine {engine_time * 1000:.3f} ms per chunk '
+              f'({engine_time / chunk_duration * 100:.1f} % of real time)')
+
+
+def loop_down_mix(data: bytes) -> bytes:
+    # stereo to mono like the former Audio.getData, with the average kept an integer
+    mono = b''
+    for i in range(0, len(data), 4):
+        num1, num2 = struct.unpack('<hh', data[i:i + 4])
+        mono += struct.pack('h', (num1 + num2) // 2)
+    return mono
+
+
+def loop_up_mix(data: bytes) -> bytes:
+    # mono to stereo like the former Audio.getData
+    stereo = b''
+    for i in range(0, len(data), 2):
+        num = struct.unpack('<h', data[i:i + 2])[0] // 2
+        stereo += struct.pack('h', num)
+        stereo += struct.pack('h', num)
+    return stereo
+
+
+def loop_wave_form(data: bytes) -> np.ndarray:
+    # stereo to a float waveform like the former Audio.getWaveForm
+    waveform = []
+    for i in range(0, len(data), 4):
+        num1, num2 = struct.unpack('<hh', data[i:i + 4])
+        waveform.append((num1 + num2) / 32768.0 / 2.0)
+    return np.array(waveform)
+
+
+def loop_load_wave_form(waveform: np.ndarray) -> bytes:
+    # a float waveform to stereo like the former Audio.loadWaveForm
+    data = b''
+    for value in waveform:
+        b = struct.pack('h', round(value * 32768))
+        data += b
+        data += b
+    return data
+
+
+def benchmark_wav(args):
+    rate = config['rate']
+    stereo = random_chunks(1, int(rate * args.seconds) * 2)[0].tobytes()
+    mono = stereo[:len(stereo) // 2]
+    waveform = np.frombuffer(mono, dtype=np.int16) / 32768.0
+    stereo_audio = ReadWrite.Audio()
+    stereo_audio.loadData(stereo, rate, 2, 2)
+    mono_audio = ReadWrite.Audio()
+    mono_audio.loadData(mono, rate, 1, 2)
+    cases = (
+        ('stereo to mono', lambda: loop_down_mix(stereo), lambda: stereo_audio.getData(rate, 1, 2)),
+        ('mono to stereo', lambda: loop_up_mix(mono), lambda: mono_audio.getData(rate, 2, 2)),
+        ('waveform', lambda: loop_wave_form(stereo), lambda: stereo_audio.getWaveForm(rate, 1, 2)),
+        ('load waveform', lambda: loop_load_wave_form(waveform), lambda: ReadWrite.Audio().loadWaveForm(waveform, rate, 2, 2)),
+    )
+    print(f'{args.seconds} s of {rate} Hz audio')
+    for name, loop, vectorized in cases:
+        start = time.perf_counter()
+        expected = loop()
+        loop_time = time.perf_counter() - start
+        start = time.perf_counter()
+        result = vectorized()
+        vectorized_time = time.perf_counter() - start
+        if isinstance(result, bytes):
+            assert result == expected, name
+        elif isinstance(result, np.ndarray):
+            assert np.array_equal(result, expected), name
+        print(f'{name}:\tloop {loop_time * 1000:.1f} ms, numpy {vectorized_time * 1000:.2f} ms')
+
+
+BENCHMARKS = {
+    'loop': benchmark_loop,
+    'topk': benchmark_topk,
+    'pitch': benchmark_pitch,
+    'wav': benchmark_wav,
+}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmarks of the chat room audio paths')
+    parser.add_argument('benchmark', choices=BENCHMARKS.keys())
+    parser.add_argument('--rooms', type=int, default=50)
+    parser.add_argument('--clients', type=int, default=20)
+    parser.add_argument('--duration', type=float, default=5.0)
+    parser.add_argument('--k', type=int, default=3)
+    parser.add_argument('--seconds', type=float, default=2.0)
+    args = parser.parse_args()
+    BENCHMARKS[args.benchmark](args)
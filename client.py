@@ -8,11 +8,24 @@ from config import config
 import time
 import numpy as np
 import cv2
-from PIL import Image, ImageTk
+from PIL import ImageTk
 import json
 import ReadWrite
+from codec import CODECS, CODECS_BY_ID
+from video import FrameDiffer, FrameGrabber, PeerFrames, VideoGallery, VideoQualityController, encode_frame
+from concurrent.futures import ThreadPoolExecutor
+from vad import VoiceActivityDetector
+from audio_buffer import JitterBuffer
+from mixer import MixMinusEngine
+from audio_engine import BlockingAudioEngine, CallbackAudioEngine
+from pitch_shift import PitchShifter
+from protocol import FLAG_DTX, FLAG_FORWARDED, FLAG_MUTE, FLAG_WANT_SELF, FLAG_WITH_SELF, SequenceTracker, pack_frame, parse_forwarded, parse_frame, timestamp_now
 import os
-import math
+
+# key of the playout buffer of the mix sent by the server, the other keys are the ids of the speakers of a forwarding room
+SERVER_MIX = 'mix'
+# key of the frames of our own camera among the frames of the peers
+MY_VIDEO = None
 # import librosa
 
 
@@ -34,21 +47,61 @@ class AudioChatClientGUI:
         self.websocket2 = None
         self.send_task = None
         self.receive_task = None
+        self.play_task = None
         self.send_video_task = None
         self.receive_video_task = None
 
-        self.record_stream = None
-        self.play_stream = None
+        # microphone and speaker, opened when joining a room
+        self.audio_engine = None
         self.is_muted = False
         self.is_recording = False
+        # event loop of the session, the recording is only opened and closed there, between two appends
+        self.loop = None
+        # codec negotiated with the server when joining a room
+        self.codec = CODECS['pcm']
+        # sequence number of the next audio frame sent to the server
+        self.send_sequence = 0
+        # silent chunks are replaced by a DTX marker every dtx_interval chunks
+        self.vad = VoiceActivityDetector(
+            self.chunk_size * config["channel"], margin_db=config["vad_margin_db"], hangover=config["vad_hangover"]
+        ) if config["vad"] else None
+        self.dtx_interval = config["dtx_interval"]
+        self.silent_chunks = 0
+        # voice change, the slider goes from -10 to 10 semitones
+        self.pitch_shifter = PitchShifter(max_steps=10)
+        # sequence numbers of the audio frames received from the server, to detect loss and reordering
+        self.receive_tracker = SequenceTracker()
+        # our id in the room, the server tags the frames it forwards with the id of their speaker
+        self.client_id = None
+        # "mix" if the server mixes the room, "forward" if it forwards the frame of every speaker
+        self.room_mode = 'mix'
+        # jitter buffers of the audio to play, the server mix or one per speaker of a forwarding room
+        self.playout_buffers = {}
+        self.peer_trackers = {}
+        self.peer_last_seen = {}
+        self.playout_mixer = MixMinusEngine(self.chunk_size * config["channel"], config["amplification_factor"])
+        # time between capturing audio and the server echoing its timestamp back, in seconds
+        self.round_trip_latency = None
+
+        # quality, frame rate and resolution of the video we send
+        self.video_quality = VideoQualityController(config)
+        # resizes and encodes the camera frames off the event loop, one at a time
+        self.video_executor = ThreadPoolExecutor(1)
+        # decodes the frames of the peers off the event loop, the GUI shows the latest one of each
+        self.peer_frames = PeerFrames(
+            ThreadPoolExecutor(config["video_decode_threads"]), (config["video_width"], config["video_height"])
+        )
+        self.video_refresh_ms = int(1000 / config["video_display_fps"])
 
         self.audio = ReadWrite.Audio()
         self.audio.loadConfig(config["rate"], config["channel"], bytesPerSample=2)
 
         # set self.audio_chunk_size to the size of each audio chunk in bytes
-        self.audio_chunk_size = config['chunk_size'] * config['channel'] * config['max_buffer_size'] * 2  # 2 bytes per sample
+        # the server mixes and sends one chunk per tick
+        self.audio_chunk_size = config['chunk_size'] * config['channel'] * 2  # 2 bytes per sample
 
         self._setup_gui()
+        self.root.after(self.video_refresh_ms, self.refresh_video)
 
         # Initially hide the mute and save recording buttons
         self.mute_button.pack_forget()
@@ -104,6 +157,8 @@ class AudioChatClientGUI:
         #self.mute_button.place(x=600,y=60)
 
         self.save_recording_button = tk.Button(controls_frame, text="Start Recording", command=self.save_recording)
+
+        self.mode_button = tk.Button(controls_frame, text="Switch Audio Mode", command=self.switch_audio_mode)
         #self.save_recording_button.pack(pady=5)
         #self.save_recording_button.place(x=600,y=110)
 
@@ -117,9 +172,10 @@ class AudioChatClientGUI:
         self.video_frame = tk.Frame(video_frame, width=200, height=150)
         self.video_frame.pack(pady=10)
 
-        self.client_video_labels = {}
-
-        self.mylbl = tk.Label(self.video_frame)
+        # every tile of the video gallery is drawn in a single label through a single image
+        self.gallery = VideoGallery((self.config["video_width"], self.config["video_height"]))
+        self.video_label = tk.Label(self.video_frame)
+        self.video_image = None
 
         # Start video capture
         self.capture = cv2.VideoCapture(0)
@@ -129,13 +185,15 @@ class AudioChatClientGUI:
         # self.save_recording_button.place(x=500,y=110)
         self.mute_button.pack(pady=5)
         self.save_recording_button.pack(pady=5)
+        self.mode_button.pack(pady=5)
 
     def hide_control_buttons(self):
         self.mute_button.pack_forget()
         self.save_recording_button.pack_forget()
+        self.mode_button.pack_forget()
 
     def create_room(self):
-        room_name = simpledialog.askstring("Input", "Enter the chat room name:", parent=self.root)
+        room_name = simpledialog.askstring("Input", "Enter the chat room name, optionally followed by topk=<k> to mix only the k loudest or mode=forward to mix on the clients:", parent=self.root)
         if room_name:
             async def create_room_async():
                 async with websockets.connect(self.uri) as websocket:
@@ -166,6 +224,19 @@ class AudioChatClientGUI:
             self.is_muted = True
             self.mute_button.config(text="Unmute")
 
+    def switch_audio_mode(self):
+        # switch the room between the server mix and forwarding, nobody has to reconnect
+        room_name = self.chat_room
+        mode = 'mix' if self.room_mode == 'forward' else 'forward'
+
+        async def switch_audio_mode_async():
+            async with websockets.connect(self.uri) as websocket:
+                await websocket.send(f"MODE {room_name} {mode}")
+                response = await websocket.recv()
+                messagebox.showinfo("Info", response)
+
+        Thread(target=lambda: asyncio.run(switch_audio_mode_async()), daemon=True).start()
+
     def connect_to_selected_room(self):
         selection = self.rooms_listbox.curselection()
         if selection:
@@ -197,168 +268,205 @@ class AudioChatClientGUI:
 
     def open_stream(self):
         self.pyaudio_instance = pyaudio.PyAudio()
+        # callback mode moves the audio through ring buffers, blocking mode through the default executor
+        engine = CallbackAudioEngine if config["audio_callback"] else BlockingAudioEngine
+        options = dict(
+            period_frames=config["audio_period_frames"], playout_chunks=config["audio_playout_chunks"],
+            capture_chunks=config["audio_capture_chunks"],
+        ) if config["audio_callback"] else {}
 
         try:
-            record_stream = self.pyaudio_instance.open(
-                format=self.audio_format,
-                channels=self.channels,
-                rate=self.rate,
-                input=True,
-                frames_per_buffer=self.chunk_size
-            )
-            play_stream = self.pyaudio_instance.open(
-                format=self.audio_format,
-                channels=self.channels,
-                rate=self.rate,
-                output=True,
-                frames_per_buffer=self.chunk_size
-            )
+            return engine(self.pyaudio_instance, self.audio_format, self.channels, self.rate, self.chunk_size, **options)
         except OSError as e:
             messagebox.showerror("Error", f"Failed to open audio stream: {e}")
-            return None, None
-
-        return record_stream, play_stream
-
-    def change_speed(self, speed, frames):
-        arr = frames
-        new_length = int(len(arr) / speed)
-        new_arr = np.zeros(new_length, dtype=np.float32)
-        win_size = 1024
-        hs = win_size // 2
-        ha = int(speed * hs)
-        # calculate the Hann window
-        hanning_window = [0] * win_size
-        for i in range(win_size):
-            hanning_window[i] = 0.5 - 0.5 * math.cos(2 * math.pi * i /(win_size - 1))
-        old_pos = 0
-        new_pos = 0
-        delta = 0
-        while old_pos + delta < len(arr) - win_size and new_pos < new_length - win_size:
-            for i in range(win_size):
-                new_arr[new_pos+i] += arr[old_pos+i] * hanning_window[i]
-            # update new_pos and old_pos
-            new_pos += hs
-            old_pos += ha
-        # new_arr = new_arr.astype(np.int16)
-        return new_arr
-        # tobytes = new_arr.tobytes()
-        # return tobytes
-
-    def pitch_interp(self,y, sr, n_steps):
-        n = len(y)
-        factor = 2 ** (1.0 * n_steps / 12.0)  # Frequency scaling factor
-        y_shifted = np.interp(np.arange(0, n, factor), np.arange(n), y)
-        return y_shifted
-
-    def change_pitch(self, frames, n_steps):
-        print("here1")
-        y = self.change_speed(1/(2 ** (1.0 * n_steps / 12.0)), frames)
-        sr = self.rate
-        # original_length = len(y.tobytes())
-        # print("length after changing speed",original_length)
-        y_shifted = self.pitch_interp(y, sr, n_steps)
-
-        # Convert back to int16
-        # y_shifted_int = y_shifted.astype(np.int16)
-
-        # Splitting the shifted audio into frames
-        # bytes_arr = y_shifted_int.tobytes()
-        # print("length after pitch change",len(bytes_arr))
-        return y_shifted
+            return None
 
     async def record_and_send(self, websocket):
         # try:
-            last_chunk = np.zeros(self.chunk_size)
-            last_shifted = np.zeros(self.chunk_size)
+            muted = False
+            # whether the last frame sent asked for the mix with self
+            sent_want_self = False
             while True:
                 if not self.is_muted:
-                    # Get the running event loop
-                    loop = asyncio.get_event_loop()
+                    if muted:
+                        # the audio captured just before unmuting must not be sent
+                        self.audio_engine.flush()
+                        muted = False
                     # before_read = time.time()
-                    data = await loop.run_in_executor(None, self.record_stream.read, self.chunk_size, False)
-                    # print("before:",len(data),data[:10],data[-10:],data[500:510])
+                    samples = await self.audio_engine.read()
+                    timestamp = timestamp_now()
                     # after_read = time.time()
                     # print(f'record: read time: {after_read - before_read}')
                     n_steps = self.n_steps.get()
-                    # time0 = time.time()
                     if n_steps != 0:
-                        # time1 = time.time()
-                        audio_array = np.frombuffer(data, dtype=np.int16)
-                        audio_float = audio_array.astype(np.float32) / np.iinfo(np.int16).max
-                        # audio_float = librosa.util.buf_to_float(audio_array, n_bytes=2, dtype=np.int16)
-                        audio_float = np.concatenate((last_chunk, audio_float))
-                        last_chunk = audio_float[-self.chunk_size:]
-                        # time2 = time.time()
-                        # shifted_data = librosa.effects.pitch_shift(audio_float, sr=self.rate, n_steps=n_steps)
-                        shifted_data = self.change_pitch(audio_float, n_steps)
-                        if len(shifted_data) < self.chunk_size*2:
-                            shifted_data = np.concatenate((shifted_data, np.zeros(self.chunk_size*2-len(shifted_data))))
-                        elif len(shifted_data) > self.chunk_size*2:
-                            shifted_data = shifted_data[:self.chunk_size*2]
-                        shifted_data = np.hanning(self.chunk_size*2) * shifted_data
-                        ready_to_send = shifted_data[:self.chunk_size] + last_shifted
-                        last_shifted = shifted_data[-self.chunk_size:]
-                        # time3 = time.time()
-                        audio_int16 = np.int16(ready_to_send * 32767)
-                        data = audio_int16.tobytes()
-                        # time4 = time.time()
-                        # print(time4-time3,time3-time2,time2-time1,time1-time0)
-                        # print("after:",len(data),data[:10],data[-10:],data[500:510])
-                    await websocket.send(data)
-                    # time5 = time.time()
-                    # print(time5-time0)
+                        self.pitch_shifter.set_steps(n_steps)
+                        samples = self.pitch_shifter.process(samples)
+                    else:
+                        # start again from silence the next time the voice is changed
+                        self.pitch_shifter.reset()
+                    # ask for the mix with our own voice only while recording
+                    want_self = self.is_recording
+                    flags = FLAG_WANT_SELF if want_self else 0
+                    if self.vad is None or self.vad.is_speech(samples):
+                        self.silent_chunks = 0
+                        await websocket.send(pack_frame(flags, len(samples), self.send_sequence, timestamp, self.codec.encode(samples)))
+                        self.send_sequence += 1
+                        sent_want_self = want_self
+                    else:
+                        # nothing to say, a marker at the start of the silence and then every dtx_interval chunks,
+                        # and right away when the recording starts or stops so the server knows at once
+                        if self.silent_chunks % self.dtx_interval == 0 or want_self != sent_want_self:
+                            await websocket.send(pack_frame(flags | FLAG_DTX, 0, self.send_sequence, timestamp))
+                            self.send_sequence += 1
+                            sent_want_self = want_self
+                        self.silent_chunks += 1
                     # after_send = time.time()
                     # print(f'record: send time: {after_send - after_read}')
                 else:
                     # sleep for the same duration as the recording interval to avoid busy waiting
                     await asyncio.sleep(self.chunk_size / self.rate)
-                    mute_message = 'MUTE'
-                    await websocket.send(mute_message)
+                    # nothing reads the microphone while muted, throw its audio away
+                    muted = True
+                    self.audio_engine.flush()
+                    sent_want_self = self.is_recording
+                    flags = FLAG_MUTE | (FLAG_WANT_SELF if sent_want_self else 0)
+                    await websocket.send(pack_frame(flags, 0, self.send_sequence, timestamp_now()))
+                    self.send_sequence += 1
                 # Give the control back
                 await asyncio.sleep(0)
         # except websockets.exceptions.ConnectionClosedError as e:
         #     print(f"Connection closed during record and send process: {e}")
 
     async def receive_and_play(self, websocket):
+        # put the received audio in the playout buffers, play_audio plays it
         try:
-            after_play = time.time()
+            loop = asyncio.get_event_loop()
             while True:
-                # message is chunks_without_self + chunks_with_self
-                before_receive = time.time()
-                interval_time = before_receive - after_play
-                print(f'interval time: {interval_time}')
+                # message is a frame header and either chunks_without_self and, if we are recording,
+                # chunks_with_self mixed by the server, or the frame of one speaker of a forwarding room
                 message = await websocket.recv()
-                after_receive = time.time()
-                print(f'receive: receive time: {after_receive - before_receive}')
-                chunks_with_self = message[:self.audio_chunk_size]
-                chunks_without_self = message[self.audio_chunk_size:]
-                after_slice = time.time()
-                print(f'receive: slice time: {after_slice - after_receive}')
+                frame = parse_frame(message)
+                if frame.flags & FLAG_FORWARDED:
+                    self.receive_forwarded(frame, loop.time())
+                    continue
+                self.room_mode = 'mix'
+                lost = self.receive_tracker.lost
+                if not self.receive_tracker.update(frame.sequence):
+                    # arrived after newer audio, too late to be played
+                    continue
+                if self.receive_tracker.lost > lost:
+                    self.playout_buffer(SERVER_MIX).put_lost(self.receive_tracker.lost - lost)
+                if frame.timestamp != 0:
+                    self.round_trip_latency = (timestamp_now() - frame.timestamp) / 1e6
+                size = self.codec.encoded_size(frame.sample_count)
+                chunks_without_self = self.codec.decode(frame.payload[:size])[:frame.sample_count].tobytes()
+                chunks_with_self = None
+                if frame.flags & FLAG_WITH_SELF:
+                    chunks_with_self = self.codec.decode(frame.payload[size:2 * size])[:frame.sample_count].tobytes()
                 #print(f'chunks_with_self: {len(chunks_with_self)}, chunks_without_self: {len(chunks_without_self)}')
                 if self.is_recording==True:
+                    if chunks_with_self is None:
+                        # the server does not know yet that we record, keep the recording in time with silence
+                        chunks_with_self = bytes(len(chunks_without_self))
                     self.audio.appendData(chunks_with_self, self.config["rate"], self.config["channel"], 2)
-                after_append = time.time()
-                print(f'receive: append time: {after_append - after_slice}')
-                if len(chunks_without_self) > 0:
-                    # run the stream.write in a separate thread to avoid blocking
-                    await asyncio.get_event_loop().run_in_executor(None, self.play_stream.write, chunks_without_self)
-                else:
-                    await asyncio.sleep(0)
-                after_play = time.time()
-                print(f'receive: play time: {after_play - after_append}')
+                self.playout_buffer(SERVER_MIX).put(np.frombuffer(chunks_without_self, dtype=np.int16), loop.time())
+                await asyncio.sleep(0)
         except websockets.exceptions.ConnectionClosedError as e:
             print(f"Connection closed during receive and play process: {e}")
 
+    def playout_buffer(self, key) -> JitterBuffer:
+        if key not in self.playout_buffers:
+            self.playout_buffers[key] = JitterBuffer(
+                self.chunk_size * self.channels, self.chunk_size / self.rate,
+                self.config["min_buffer_size"], self.config["max_buffer_size"],
+                concealment=self.config["playout_concealment"], drift_margin=self.config["playout_drift_margin"],
+                drift_control=self.config["playout_drift_control"]
+            )
+        return self.playout_buffers[key]
+
+    def receive_forwarded(self, frame, arrival_time: float):
+        # the frame of one speaker of a forwarding room, decoded with the codec of the speaker
+        self.room_mode = 'forward'
+        sender_id, codec_id, payload = parse_forwarded(frame)
+        tracker = self.peer_trackers.setdefault(sender_id, SequenceTracker())
+        lost = tracker.lost
+        if not tracker.update(frame.sequence):
+            return
+        self.peer_last_seen[sender_id] = arrival_time
+        buffer = self.playout_buffer(sender_id)
+        if tracker.lost > lost:
+            buffer.put_lost(tracker.lost - lost)
+        if frame.flags & FLAG_DTX:
+            # the speaker is silent until its next frame of audio
+            buffer.pause()
+            return
+        buffer.put(CODECS_BY_ID[codec_id].decode(payload)[:frame.sample_count], arrival_time)
+
+    async def play_audio(self):
+        # play one chunk per tick, the write to the audio engine paces the loop
+        # in a forwarding room the speakers are mixed here, with the same mix-minus as the server:
+        # our own frames only come back while recording and are only mixed into the recording
+        loop = asyncio.get_event_loop()
+        silence = np.zeros(self.chunk_size * self.channels, dtype=np.int16)
+        while True:
+            mixer = self.playout_mixer
+            mixer.reset()
+            own_row = None
+            server_mix = None
+            for key, buffer in list(self.playout_buffers.items()):
+                if key != SERVER_MIX and len(buffer) == 0 and loop.time() - self.peer_last_seen[key] > 10:
+                    # the speaker left or was muted a while ago, its id may be given to someone else
+                    del self.playout_buffers[key]
+                    self.peer_trackers.pop(key, None)
+                    continue
+                samples = buffer.get()
+                if samples is None:
+                    continue
+                if key == SERVER_MIX:
+                    server_mix = samples
+                else:
+                    row = mixer.load(samples)
+                    if key == self.client_id:
+                        own_row = row
+
+            playback = silence if server_mix is None else server_mix
+            if mixer.count > 0:
+                rows, _ = mixer.mix_rows()
+                speakers = rows[0] if own_row is None else rows[own_row + 1]
+                # while the room switches mode, the last chunks of both paths are played together
+                playback = np.clip(speakers.astype(np.int32) + playback, -32768, 32767).astype(np.int16)
+            if self.room_mode == 'forward' and self.is_recording:
+                recording = rows[0] if mixer.count > 0 else silence
+                self.audio.appendData(recording.tobytes(), self.config["rate"], self.config["channel"], 2)
+            await self.audio_engine.write(playback)
+
+    def call_on_loop(self, callback):
+        # run the callback on the event loop of the session, where the recording is appended to,
+        # or right away if the session is over
+        if self.loop is not None and self.loop.is_running():
+            self.loop.call_soon_threadsafe(callback)
+        else:
+            callback()
+
+    def start_recording(self):
+        if self.audio.stream is None:
+            self.audio.openStream(os.path.join(os.getcwd(), self.config["record_path"]))
+        self.is_recording = True
+
+    def stop_recording(self):
+        # the recording is already on disk, only its header is completed
+        if self.audio.stream is not None:
+            self.audio.closeStream()
+            print("saved")
+
     def save_recording(self):
         if self.is_recording == True:
-            self.audio.write(os.path.join(os.getcwd(), self.config["record_path"]))
-            self.audio = ReadWrite.Audio()
-            self.audio.loadConfig(config["rate"], config["channel"], bytesPerSample=2)
-            print("saved")
+            # no new chunk is appended from now on, the ones being appended are before the close in the loop
             self.is_recording = False
+            self.call_on_loop(self.stop_recording)
             self.save_recording_button.config(text="Start Recording")
         else:
-            self.is_recording = True
+            self.call_on_loop(self.start_recording)
             self.save_recording_button.config(text="End Recording")
 
     async def receive_and_play_video(self, websocket):
@@ -369,126 +477,123 @@ class AudioChatClientGUI:
                 #print("video received:", message[:10])
                 after_receive_time = time.time()
                 # print(f'video:Receive: receive time: {after_receive_time - before_receive_time}')
+                if message[0:1] == b'F':
+                    # congestion report of the server about the receivers of our video
+                    self.video_quality.on_feedback(json.loads(message[1:]))
+                    continue
                 client_id = message[1:5]
                 if message[0:1] == b'X':
-                    print("here5",self.client_video_labels,client_id)
-                    self.client_video_labels[client_id].pack_forget()
-                    self.client_video_labels.pop(client_id)
+                    # the label is hidden at the next refresh of the GUI
+                    self.peer_frames.remove(client_id)
                     continue
                 # if message[0:1] != b'V':
                 #     print("Invalid message received: ", message[:10])
                 #     continue
-                frame = cv2.imdecode(np.frombuffer(message[5:], np.uint8), cv2.IMREAD_COLOR)
-
-                # cv_image = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
-                # pil_image = Image.fromarray(cv_image)
-                # image_tk = ImageTk.PhotoImage(image=pil_image)
-                # # cv2.imshow('Receiver', frame)
-                # # 如果这是新的客户端，创建一个新的标签
-                # if client_id not in self.client_video_labels:
-                #     self.add_video_label(client_id)
-                #
-                # # 更新对应客户端的视频标签
-                # label = self.client_video_labels[client_id]
-                # label.imgtk = image_tk
-                # label.configure(image=image_tk)
-                # after_play_time = time.time()
-                try:
-                    self.root.after(0, self.update_client_video, client_id, frame)
-                except Exception as e:
-                    print("here2",e)
-                after_update_time = time.time()
-                # print(f'video:Receive: update time: {after_update_time - after_receive_time}')
-                # print(f'video:Receive: receive time: {after_receive_time - before_receive_time}, play time: {after_play_time - after_receive_time}')
+                # a keyframe or a patch, decoded in the worker pool, a frame still waiting there is replaced by this one
+                self.peer_frames.submit(client_id, memoryview(message)[5:])
                 await asyncio.sleep(0)
         except websockets.exceptions.ConnectionClosedError as e:
             print(f"Connection closed during receive and play video process: {e}")
 
-    def update_my_lbl(self, frame):
-        cv_image = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
-        pil_image = Image.fromarray(cv_image)
-        image_tk = ImageTk.PhotoImage(image=pil_image)
-        self.mylbl.imgtk = image_tk
-        self.mylbl.configure(image=image_tk)
-
-    def update_client_video(self, client_id, frame):
-        cv_image = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
-        pil_image = Image.fromarray(cv_image)
-        image_tk = ImageTk.PhotoImage(image=pil_image)
-        # cv2.imshow('Receiver', frame)
-        # 如果这是新的客户端，创建一个新的标签
-        if client_id not in self.client_video_labels:
-            self.add_video_label(client_id)
-
-        # 更新对应客户端的视频标签
-        label = self.client_video_labels[client_id]
-        label.imgtk = image_tk
-        label.configure(image=image_tk)
-
-    def add_video_label(self, client_id):
-        if client_id not in self.client_video_labels:
-            # 创建一个Label来显示视频
-            label = tk.Label(self.video_frame)
-            label.pack(side="left", padx=10)
-            self.client_video_labels[client_id] = label
+    def refresh_video(self):
+        # runs on the Tk thread video_display_fps times per second, copies the latest frame of every
+        # peer and of our camera into its tile of the gallery and shows the gallery once
+        try:
+            frames, left = self.peer_frames.take()
+            for client_id in left:
+                self.gallery.remove(client_id)
+            for client_id, frame in frames.items():
+                self.gallery.draw(client_id, frame)
+            if self.gallery.dirty:
+                self.show_gallery()
+        except Exception as e:
+            print("here2",e)
+        self.root.after(self.video_refresh_ms, self.refresh_video)
+
+    def show_gallery(self):
+        # paste the canvas into the persistent image, a new image is only made when the grid changes size
+        image = self.gallery.image()
+        if self.video_image is None or self.video_image.width() != image.width or self.video_image.height() != image.height:
+            self.video_image = ImageTk.PhotoImage(image=image)
+            self.video_label.configure(image=self.video_image)
+        else:
+            self.video_image.paste(image)
 
     async def record_and_send_video(self, websocket):
-        while self.capture.isOpened():
-            #print("here111")
-            before_read_time = time.time()
-            # loop = asyncio.get_running_loop()
-            # ret, frame = await loop.run_in_executor(None, self.capture.read)
-            ret, frame = self.capture.read()
-            if not ret:
-                break
-            frame = cv2.resize(frame, (200, 150))
-            # Here you would need to encode the frame using a codec like H.264
-            _, buffer = cv2.imencode('.jpg', frame)
-            after_read_time = time.time()
-            # print(f'record video: read time: {after_read_time - before_read_time}')
-            bytes_buffer = buffer.tobytes()
-            image_size = len(bytes_buffer)
-            #print(image_size)
-            await websocket.send(b"VIDEO" + bytes_buffer)
-            after_send_time = time.time()
-            # print(f'record video: send time: {after_send_time - after_read_time}')
-            # frame_show = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
-            #
-            # img = Image.fromarray(frame_show)
-            #
-            # imgtk = ImageTk.PhotoImage(image=img)
-            #
-            # self.mylbl.imgtk = imgtk
-            # self.mylbl.configure(image=imgtk)
-            try:
-                self.root.after(0, self.update_my_lbl, frame)
-            except Exception as e:
-                print("here1",e)
-            update_self_time = time.time()
-            # print(f'record video: update self time: {update_self_time - after_send_time}')
-            #print(
-            #    f'video: read time: {after_read_time - before_read_time}, send time: {after_send_time - after_read_time}')
-            # Mimic the delay of video encoding
-            await asyncio.sleep(0.033)  # Roughly 30 frames per second
+        # the camera is read by its own thread and the frames are resized and encoded in the encode worker,
+        # the loop only awaits the encoded buffer and sends it
+        loop = asyncio.get_running_loop()
+        grabber = FrameGrabber(self.capture)
+        grabber.start()
+        # only the frames and regions that changed are sent, with a keyframe every video_keyframe_interval seconds
+        differ = FrameDiffer(keyframe_interval=self.config["video_keyframe_interval"])
+        try:
+            deadline = loop.time()
+            while grabber.running:
+                quality = self.video_quality
+                frame = grabber.take()
+                if frame is None:
+                    # no new frame from the camera since the last one we sent
+                    pass
+                elif websocket.transport.get_write_buffer_size() > 0:
+                    # the previous frame is still going out, skip this one so that the audio is not starved
+                    quality.on_uplink_backlog()
+                else:
+                    # Here you would need to encode the frame using a codec like H.264
+                    preview, bytes_buffer = await loop.run_in_executor(
+                        self.video_executor, encode_frame, frame, (quality.width, quality.height), quality.size,
+                        quality.quality, differ, loop.time()
+                    )
+                    if bytes_buffer is not None:
+                        await websocket.send(b"VIDEO" + bytes_buffer)
+                    # shown at the next refresh of the GUI
+                    self.peer_frames.put(MY_VIDEO, preview)
+                # frames are due on a fixed schedule of the monotonic clock, at the rate the congestion feedback
+                # allows, from video_min_fps to video_max_fps, however long the frame took
+                deadline += 1 / quality.fps
+                if deadline < loop.time():
+                    # fell behind by more than a frame, restart the schedule from now
+                    deadline = loop.time()
+                await asyncio.sleep(deadline - loop.time())
+        finally:
+            grabber.stop()
 
     async def run(self):
+        self.loop = asyncio.get_running_loop()
         try:
+            # ask the server which ports serve the room, it may be owned by another worker process
             async with websockets.connect(self.uri) as websocket:
-                await websocket.send(self.chat_room)  # Use the GUI-input chat room name
+                await websocket.send(f"ROUTE {self.chat_room}")
+                route = self.server_reply(await websocket.recv())
+                if route is None:
+                    return
+
+            async with websockets.connect(f"ws://{config['ip']}:{route['audio_port']}") as websocket:
+                # Use the GUI-input chat room name, and offer our codecs in order of preference
+                await websocket.send(json.dumps({"room": self.chat_room, "codecs": config["codecs"]}))
+                joined = self.server_reply(await websocket.recv())
+                if joined is None:
+                    return
+                self.codec = CODECS[joined["codec"]]
+                self.client_id = joined.get("id")
+                self.room_mode = joined.get("mode", 'mix')
+                self.playout_buffers = {}
+                self.peer_trackers = {}
                 if not self.capture.isOpened():
                     # open camera failed
                     exit()
-                self.record_stream, self.play_stream = self.open_stream()
+                self.audio_engine = self.open_stream()
                 self.send_task = asyncio.create_task(self.record_and_send(websocket))
                 self.receive_task = asyncio.create_task(self.receive_and_play(websocket))
+                self.play_task = asyncio.create_task(self.play_audio())
 
-                self.websocket2 = await websockets.connect(f"ws://{config['ip']}:5679")
+                self.websocket2 = await websockets.connect(f"ws://{config['ip']}:{route['video_port']}")
                 await self.websocket2.send(json.dumps({"room": self.chat_room, "user": self.username, "type": "video"}))
                 self.send_video_task = asyncio.create_task(self.record_and_send_video(self.websocket2))
                 self.receive_video_task = asyncio.create_task(self.receive_and_play_video(self.websocket2))
-                self.mylbl.pack()
+                self.video_label.pack()
                 try:
-                    await asyncio.gather(self.send_task, self.receive_task, self.send_video_task, self.receive_video_task)
+                    await asyncio.gather(self.send_task, self.receive_task, self.play_task, self.send_video_task, self.receive_video_task)
                 except asyncio.CancelledError:
                     print("Cancelled")
                     await self.websocket2.close()
@@ -499,6 +604,16 @@ class AudioChatClientGUI:
         # finally:
         #     await self.disconnect()
 
+    def server_reply(self, reply):
+        # the JSON reply to a request, or None if the server refused it with a message such as "Server full."
+        try:
+            return json.loads(reply)
+        except json.JSONDecodeError:
+            messagebox.showinfo("Info", reply)
+            self.hide_control_buttons()
+            self.update_ui_after_disconnect()
+            return None
+
     async def disconnect(self):
         self.hide_control_buttons()
         if self.send_task is not None:
@@ -507,6 +622,9 @@ class AudioChatClientGUI:
         if self.receive_task is not None:
             self.receive_task.cancel()
             self.receive_task = None
+        if self.play_task is not None:
+            self.play_task.cancel()
+            self.play_task = None
         if self.send_video_task is not None:
             self.send_video_task.cancel()
             self.send_video_task = None
@@ -516,14 +634,14 @@ class AudioChatClientGUI:
         self.cleanup_resources()
 
     def cleanup_resources(self):
-        if self.record_stream is not None:
-            self.record_stream.stop_stream()
-            self.record_stream.close()
-            self.record_stream = None
-        if self.play_stream is not None:
-            self.play_stream.stop_stream()
-            self.play_stream.close()
-            self.play_stream = None
+        if self.audio_engine is not None:
+            self.audio_engine.close()
+            self.audio_engine = None
+        if self.is_recording:
+            # keep what was recorded until now
+            self.is_recording = False
+            self.call_on_loop(self.stop_recording)
+            self.save_recording_button.config(text="Start Recording")
         if self.pyaudio_instance is not None:
             self.pyaudio_instance.terminate()
             self.pyaudio_instance = None
@@ -532,12 +650,9 @@ class AudioChatClientGUI:
     def update_ui_after_disconnect(self):
         self.status_label.config(text="Disconnected", fg="red")
         self.chat_room = ""
-        print(self.client_video_labels)
-        for label in self.client_video_labels.values():
-            print("here")
-            label.pack_forget()
-        self.client_video_labels = {}
-        self.mylbl.pack_forget()
+        self.peer_frames.clear()
+        self.gallery.clear()
+        self.video_label.pack_forget()
 
     def disconnect_from_room(self):
         asyncio.run(self.disconnect())
@@ -0,0 +1,182 @@
+import numpy as np
+from typing import Dict, List
+
+
+class Codec:
+    """
+    Audio codec of the chat, written in plain NumPy. encode_rows encodes every row of a 2-D int16
+    array in one vectorized call, which is how the server encodes all the listener mixes of a tick.
+    """
+    name = ''
+    # identifies the codec in forwarded frames
+    id = -1
+
+    def encoded_size(self, n_samples: int) -> int:
+        raise NotImplementedError
+
+    def encode_rows(self, rows: np.ndarray) -> List[bytes]:
+        raise NotImplementedError
+
+    def decode(self, data: bytes) -> np.ndarray:
+        raise NotImplementedError
+
+    def encode(self, samples: np.ndarray) -> bytes:
+        return self.encode_rows(samples.reshape(1, -1))[0]
+
+
+class PCMCodec(Codec):
+    # raw 16-bit samples
+    name = 'pcm'
+    id = 0
+
+    def encoded_size(self, n_samples: int) -> int:
+        return 2 * n_samples
+
+    def encode_rows(self, rows: np.ndarray) -> List[bytes]:
+        rows = rows.astype(np.int16, copy=False)
+        return [row.tobytes() for row in rows]
+
+    def decode(self, data: bytes) -> np.ndarray:
+        return np.frombuffer(data, dtype=np.int16)
+
+
+def _mulaw_tables():
+    # G.711 mu-law, computed once for every int16 value so encoding is a single table lookup
+    samples = np.arange(-32768, 32768, dtype=np.int32)
+    sign = np.where(samples < 0, 0x80, 0)
+    magnitude = np.minimum(np.abs(samples), 32635) + 0x84
+    exponent = np.floor(np.log2(magnitude)).astype(np.int32) - 7
+    mantissa = (magnitude >> (exponent + 3)) & 0x0F
+    encode_table = (~(sign | (exponent << 4) | mantissa) & 0xFF).astype(np.uint8)
+    # index the table with the samples reinterpreted as uint16
+    encode_table = np.roll(encode_table, -32768)
+
+    codes = ~np.arange(256, dtype=np.int32) & 0xFF
+    exponent = (codes >> 4) & 0x07
+    mantissa = codes & 0x0F
+    magnitude = (((mantissa << 3) + 0x84) << exponent) - 0x84
+    decode_table = np.where(codes & 0x80, -magnitude, magnitude).astype(np.int16)
+    return encode_table, decode_table
+
+
+class MuLawCodec(Codec):
+    # G.711 mu-law, 8 bits per sample (2:1)
+    name = 'ulaw'
+    id = 1
+
+    def __init__(self):
+        self.encode_table, self.decode_table = _mulaw_tables()
+
+    def encoded_size(self, n_samples: int) -> int:
+        return n_samples
+
+    def encode_rows(self, rows: np.ndarray) -> List[bytes]:
+        codes = self.encode_table[rows.astype(np.int16, copy=False).view(np.uint16)]
+        return [row.tobytes() for row in codes]
+
+    def decode(self, data: bytes) -> np.ndarray:
+        return self.decode_table[np.frombuffer(data, dtype=np.uint8)]
+
+
+IMA_STEP_TABLE = np.array([
+    7, 8, 9, 10, 11, 12, 13, 14, 16, 17, 19, 21, 23, 25, 28, 31, 34, 37, 41, 45,
+    50, 55, 60, 66, 73, 80, 88, 97, 107, 118, 130, 143, 157, 173, 190, 209, 230, 253, 279, 307,
+    337, 371, 408, 449, 494, 544, 598, 658, 724, 796, 876, 963, 1060, 1166, 1282, 1411, 1552, 1707, 1878, 2066,
+    2272, 2499, 2749, 3024, 3327, 3660, 4026, 4428, 4871, 5358, 5894, 6484, 7132, 7845, 8630, 9493, 10442, 11487,
+    12635, 13899, 15289, 16818, 18500, 20350, 22385, 24623, 27086, 29794, 32767,
+], dtype=np.int32)
+IMA_INDEX_TABLE = np.array([-1, -1, -1, -1, 2, 4, 6, 8, -1, -1, -1, -1, 2, 4, 6, 8], dtype=np.int32)
+
+
+def _ima_tables():
+    # for every (step index, code) pair, the signed predictor update and the next step index,
+    # so each ADPCM step is a couple of table lookups
+    step = IMA_STEP_TABLE[:, None]
+    code = np.arange(16)[None, :]
+    difference = (step >> 3) + (code & 4 > 0) * step + (code & 2 > 0) * (step >> 1) + (code & 1) * (step >> 2)
+    difference = np.where(code & 8, -difference, difference)
+    next_index = np.clip(np.arange(89)[:, None] + IMA_INDEX_TABLE[None, :], 0, 88)
+    return difference.ravel().astype(np.int32), next_index.ravel().astype(np.int32)
+
+
+IMA_DIFFERENCE, IMA_NEXT_INDEX = _ima_tables()
+
+
+class ImaAdpcmCodec(Codec):
+    """
+    IMA-ADPCM, 4 bits per sample. The samples are split into independent blocks, each starting with a
+    4-byte header (first sample as int16, step index, reserved byte) like the blocks of IMA-ADPCM WAV
+    files. ADPCM is sequential within a block, but all the blocks of all the rows are coded in
+    parallel, so a chunk costs block_size vectorized steps whatever the number of rows. Blocks of 64
+    samples give 3.6:1 and keep a 2048-sample chunk at about 1 ms to encode or decode.
+    """
+    name = 'adpcm'
+    id = 2
+
+    def __init__(self, block_size: int = 64):
+        self.block_size = block_size
+        self.block_bytes = 4 + block_size // 2
+
+    def encoded_size(self, n_samples: int) -> int:
+        return -(-n_samples // self.block_size) * self.block_bytes
+
+    def encode_rows(self, rows: np.ndarray) -> List[bytes]:
+        n_rows, n_samples = rows.shape
+        n_blocks = -(-n_samples // self.block_size)
+        padded = np.zeros((n_rows, n_blocks * self.block_size), dtype=np.int32)
+        padded[:, :n_samples] = rows
+        blocks = padded.reshape(n_rows * n_blocks, self.block_size)
+
+        predictor = blocks[:, 0].copy()
+        # start every block with a step close to the typical difference between its samples
+        mean_diff = np.abs(np.diff(blocks, axis=1)).mean(axis=1)
+        index = np.clip(np.searchsorted(IMA_STEP_TABLE, mean_diff), 0, 88)
+        start_index = index.copy()
+
+        codes = np.zeros((len(blocks), self.block_size), dtype=np.uint8)
+        for t in range(1, self.block_size):
+            diff = blocks[:, t] - predictor
+            # quantize the difference to 3 bits of magnitude and a sign bit
+            code = np.minimum(np.abs(diff) * 4 // IMA_STEP_TABLE[index], 7) | ((diff < 0) * 8)
+            # update the predictor exactly like the decoder does
+            state = index * 16 + code
+            predictor = np.clip(predictor + IMA_DIFFERENCE[state], -32768, 32767)
+            index = IMA_NEXT_INDEX[state]
+            codes[:, t] = code
+
+        header = np.zeros((len(blocks), 4), dtype=np.uint8)
+        header[:, 0:2] = blocks[:, 0].astype('<i2').view(np.uint8).reshape(-1, 2)
+        header[:, 2] = start_index
+        # two codes per byte, the first one in the low nibble, the code slot of the header sample is unused
+        packed = codes[:, 0::2] | (codes[:, 1::2] << 4)
+        encoded = np.concatenate((header, packed), axis=1).reshape(n_rows, -1)
+        return [row.tobytes() for row in encoded]
+
+    def decode(self, data: bytes) -> np.ndarray:
+        blocks = np.frombuffer(data, dtype=np.uint8).reshape(-1, self.block_bytes)
+        predictor = blocks[:, 0:2].copy().view('<i2')[:, 0].astype(np.int32)
+        index = np.minimum(blocks[:, 2], 88).astype(np.int32)
+        codes = np.empty((len(blocks), self.block_size), dtype=np.int32)
+        codes[:, 0::2] = blocks[:, 4:] & 0x0F
+        codes[:, 1::2] = blocks[:, 4:] >> 4
+
+        samples = np.empty((len(blocks), self.block_size), dtype=np.int16)
+        samples[:, 0] = predictor
+        for t in range(1, self.block_size):
+            state = index * 16 + codes[:, t]
+            predictor = np.clip(predictor + IMA_DIFFERENCE[state], -32768, 32767)
+            index = IMA_NEXT_INDEX[state]
+            samples[:, t] = predictor
+        return samples.reshape(-1)
+
+
+CODECS: Dict[str, Codec] = {codec.name: codec for codec in (PCMCodec(), MuLawCodec(), ImaAdpcmCodec())}
+CODECS_BY_ID: Dict[int, Codec] = {codec.id: codec for codec in CODECS.values()}
+
+
+def negotiate(offered: List[str]) -> Codec:
+    # pick the first codec offered by the client that the server knows, raw PCM otherwise
+    for name in offered:
+        if name in CODECS:
+            return CODECS[name]
+    return CODECS['pcm']
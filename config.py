@@ -4,14 +4,78 @@ config = {
     # "ip": "10.13.59.229",
     "ip": "10.13.62.241",
     "port": 5678,
+    # number of server worker processes, with more than one the rooms are spread over the workers
+    "workers": 1,
 
     "channel": 1,
     "rate": 44100,
     "chunk_size": 2048,
+    # audio codecs offered to the server when joining a room, in order of preference: "ulaw", "adpcm", "pcm"
+    "codecs": ["ulaw", "adpcm", "pcm"],
 
+    # send DTX markers instead of the chunks in which the voice activity detector hears no speech
+    "vad": True,
+    # dB above the noise floor for a sound to be speech
+    "vad_margin_db": 12,
+    # number of chunks still sent after the end of speech, so that the tail of words is not cut
+    "vad_hangover": 6,
+    # number of chunks between two DTX markers while silent
+    "dtx_interval": 8,
+
+    # move the audio through ring buffers filled and drained by PyAudio callbacks instead of blocking
+    # reads and writes in a thread pool
+    "audio_callback": True,
+    # frames per callback, and chunks the playback and capture rings hold
+    "audio_period_frames": 512,
+    "audio_playout_chunks": 2,
+    "audio_capture_chunks": 4,
+
+    "min_buffer_size": 1,
     "max_buffer_size": 4,
+    # chunks of a gap in the received audio the client fills with the last chunk fading out
+    "playout_concealment": 3,
+    # fraction of a chunk the client buffers on top of the jitter, so that it can slow down for a sender
+    # with a slower clock before it runs dry
+    "playout_drift_margin": 0.25,
+    # the client follows the smoothed depth of its playout buffers to take up clock drift, the server
+    # keeps the plain step control that underruns less on its buffers
+    "playout_drift_control": True,
+
+    # number of mixed chunks queued for a client before the oldest one is dropped
+    "send_queue_size": 4,
+    # a client is disconnected after this many dropped chunks in a row
+    "max_send_drops": 50,
 
     "amplification_factor": 3,
+    # mix only the topk loudest clients of a room, None to mix everyone, "CREATE <room> topk=<k>" overrides it
+    "topk": None,
+    # mix the rooms in a pool of mix_threads threads instead of on the event loop
+    "mix_in_executor": False,
+    "mix_threads": 4,
+
+    # port of the local Prometheus-style metrics endpoint of the server, None to disable it
+    "metrics_port": 9100,
+    # file the server periodically writes its metrics to, None to disable it
+    "metrics_snapshot_path": None,
+    "metrics_snapshot_interval": 10,
+    # print a trace of every mixing tick on the server
+    "debug": False,
+    # bounds of the video we send, adapted to how the receivers and our uplink keep up
+    "video_width": 200,
+    "video_height": 150,
+    "video_min_quality": 30,
+    "video_max_quality": 90,
+    "video_min_fps": 5,
+    "video_max_fps": 30,
+    "video_min_scale": 0.5,
+    # seconds between two congestion reports of the server to a video sender
+    "video_feedback_interval": 1.0,
+    # seconds between two full frames, the frames in between only carry the region that changed
+    "video_keyframe_interval": 2.0,
+    # threads decoding the video of the peers, and times per second the GUI shows the latest frames
+    "video_decode_threads": 2,
+    "video_display_fps": 30,
+
     "my_name": "yhhh",
     
     "record_path": "last_recording.wav"
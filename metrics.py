@@ -0,0 +1,114 @@
+import asyncio
+import bisect
+import os
+from typing import Dict, List, Tuple
+
+
+class Counter:
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+
+class Histogram:
+    def __init__(self, buckets: List[float]):
+        self.buckets = sorted(buckets)
+        # the last count is the +Inf bucket
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+# buckets for durations in seconds, from 0.1 ms to 1 s
+TIME_BUCKETS = [0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0]
+# buckets for queue depths in chunks
+DEPTH_BUCKETS = [0, 1, 2, 3, 4, 6, 8, 12, 16]
+
+
+class MetricsRegistry:
+    """
+    In-memory counters and histograms, rendered in the Prometheus text format.
+    Updating a metric is a plain attribute update, so it is cheap enough for the audio hot path.
+    """
+    def __init__(self):
+        # Maps metric names to (type, help text, dict of label tuples to metric)
+        self.metrics: Dict[str, Tuple[str, str, Dict[Tuple, object]]] = {}
+
+    def _get(self, kind: str, name: str, help_text: str, labels: Dict[str, str], factory):
+        if name not in self.metrics:
+            self.metrics[name] = (kind, help_text, {})
+        series = self.metrics[name][2]
+        key = tuple(sorted(labels.items()))
+        if key not in series:
+            series[key] = factory()
+        return series[key]
+
+    def counter(self, name: str, help_text: str, **labels) -> Counter:
+        return self._get('counter', name, help_text, labels, Counter)
+
+    def histogram(self, name: str, help_text: str, buckets: List[float], **labels) -> Histogram:
+        return self._get('histogram', name, help_text, labels, lambda: Histogram(buckets))
+
+    def remove(self, **labels):
+        # drop every series that has all the given labels, e.g. when a room is deleted
+        items = set(labels.items())
+        for _, _, series in self.metrics.values():
+            for key in [key for key in series if items.issubset(key)]:
+                del series[key]
+
+    def render(self) -> str:
+        lines = []
+        for name, (kind, help_text, series) in self.metrics.items():
+            lines.append(f'# HELP {name} {help_text}')
+            lines.append(f'# TYPE {name} {kind}')
+            for key, metric in series.items():
+                if kind == 'counter':
+                    lines.append(f'{name}{format_labels(key)} {metric.value}')
+                else:
+                    cumulative = 0
+                    for bound, count in zip(metric.buckets + ['+Inf'], metric.counts):
+                        cumulative += count
+                        lines.append(f'{name}_bucket{format_labels(key + (("le", str(bound)),))} {cumulative}')
+                    lines.append(f'{name}_sum{format_labels(key)} {metric.sum}')
+                    lines.append(f'{name}_count{format_labels(key)} {metric.count}')
+        return '\n'.join(lines) + '\n'
+
+    async def serve(self, host: str, port: int):
+        # minimal HTTP endpoint that answers every request with the current metrics
+        async def handle(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+            try:
+                await reader.readline()
+                body = self.render().encode('utf-8')
+                writer.write(b'HTTP/1.0 200 OK\r\n'
+                             b'Content-Type: text/plain; version=0.0.4\r\n'
+                             b'Content-Length: ' + str(len(body)).encode() + b'\r\n\r\n' + body)
+                await writer.drain()
+            finally:
+                writer.close()
+
+        server = await asyncio.start_server(handle, host, port)
+        print(f"Metrics served at http://{host}:{port}/metrics")
+        async with server:
+            await server.serve_forever()
+
+    async def write_snapshots(self, path: str, interval: float):
+        # periodically write the metrics to a file, replaced atomically so readers never see half a file
+        while True:
+            await asyncio.sleep(interval)
+            tmp_path = path + '.tmp'
+            with open(tmp_path, 'w') as file:
+                file.write(self.render())
+            os.replace(tmp_path, path)
+
+
+def format_labels(key: Tuple) -> str:
+    if len(key) == 0:
+        return ''
+    return '{' + ','.join(f'{label}="{value}"' for label, value in key) + '}'
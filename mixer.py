@@ -0,0 +1,130 @@
+import heapq
+import numpy as np
+from typing import Dict, Hashable, List, Set, Tuple
+
+
+class MixMinusEngine:
+    """
+    Mixes the audio of all participants of a room and computes every "minus-self" mix in one
+    vectorized pass. The buffers are preallocated and only grow when a room gets bigger.
+    """
+    def __init__(self, chunk_samples: int, amplification_factor, capacity: int = 8):
+        self.amplification_factor = amplification_factor
+        self.chunk_samples = 0
+        self.capacity = 0
+        self.count = 0
+        self.allocate(capacity, chunk_samples)
+
+    def allocate(self, capacity: int, chunk_samples: int):
+        # one row per participant, int32 to avoid overflow while summing
+        stack = np.zeros((capacity, chunk_samples), dtype=np.int32)
+        if self.count > 0:
+            # keep the rows that are already loaded
+            stack[:self.count, :self.chunk_samples] = self.stack[:self.count]
+        self.stack = stack
+        # row 0 is the full mix, row i + 1 is the mix without participant i
+        self.mixes = np.zeros((capacity + 1, chunk_samples), dtype=np.int32)
+        self.output = np.zeros((capacity + 1, chunk_samples), dtype=np.int16)
+        self.capacity = capacity
+        self.chunk_samples = chunk_samples
+
+    def reset(self):
+        self.count = 0
+
+    def load(self, samples: np.ndarray) -> int:
+        # copy the int16 samples of one participant into the next free row and return its index
+        if self.count == self.capacity or len(samples) > self.chunk_samples:
+            capacity = 2 * self.capacity if self.count == self.capacity else self.capacity
+            self.allocate(capacity, max(self.chunk_samples, len(samples)))
+        row = self.stack[self.count]
+        row[:len(samples)] = samples
+        row[len(samples):] = 0
+        self.count += 1
+        return self.count - 1
+
+    def mix_rows(self) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Mix the loaded rows. Returns the int16 mixes, row 0 being the full mix and row i + 1 the mix
+        without the i-th loaded participant, and a mask of the participants that contributed only
+        silence, whose mix without self is the full mix.
+        """
+        n = self.count
+        stack = self.stack[:n]
+        mixes = self.mixes[:n + 1]
+        output = self.output[:n + 1]
+
+        np.sum(stack, axis=0, out=mixes[0])
+        # all the mix-minus rows at once by broadcasting the full mix against the stack
+        np.subtract(mixes[0], stack, out=mixes[1:])
+        # amplify and clip every mix in place
+        np.multiply(mixes, self.amplification_factor, out=mixes, casting='unsafe')
+        np.clip(mixes, -32768, 32767, out=mixes)
+        np.copyto(output, mixes, casting='unsafe')
+        return output, ~stack.any(axis=1)
+
+    def mix(self) -> Tuple[bytes, List[bytes]]:
+        """
+        Mix the loaded rows. Returns the encoded full mix and the encoded mix without each loaded
+        participant, in load order. Participants that contributed only silence share the bytes
+        object of the full mix.
+        """
+        output, silent = self.mix_rows()
+        mixed_chunk_byte = output[0].tobytes()
+        without_self = [mixed_chunk_byte if silent[i] else output[i + 1].tobytes() for i in range(self.count)]
+        return mixed_chunk_byte, without_self
+
+    def mix_chunks(self, chunks: List[np.ndarray]) -> Tuple[bytes, List[bytes]]:
+        self.reset()
+        for chunk in chunks:
+            self.load(chunk)
+        return self.mix()
+
+
+class ActiveSpeakerSelector:
+    """
+    Picks the K loudest participants of a room from a short-term estimate of their level. A participant
+    only takes the place of a selected one if it is louder by hysteresis_db, so the selection does not
+    flap between speakers of about the same level.
+    """
+    def __init__(self, k: int, hysteresis_db: float = 6.0, smoothing: float = 0.3):
+        self.k = k
+        self.hysteresis_db = hysteresis_db
+        # weight of the newest chunk in the moving average of the level
+        self.smoothing = smoothing
+        self.levels: Dict[Hashable, float] = {}
+        self.selected: Set[Hashable] = set()
+
+    def update(self, key: Hashable, samples: np.ndarray):
+        # fold the level of a new chunk of the participant, in dB relative to full scale, into its average
+        samples = samples.astype(np.float32)
+        level = 10 * np.log10(np.dot(samples, samples) / (len(samples) * 32768.0 ** 2) + 1e-12)
+        previous = self.levels.get(key, level)
+        self.levels[key] = previous + self.smoothing * (level - previous)
+
+    def level(self, key: Hashable) -> float:
+        return self.levels.get(key, -120.0)
+
+    def select(self, candidates: List[Hashable]) -> Set[Hashable]:
+        # the participants to mix among the candidates, the ones that have audio for this tick
+        level = self.level
+        available = set(candidates)
+        selected = {key for key in self.selected if key in available}
+        # the loop below stops after k additions and k replacements at most, so only the 2k + 1 loudest
+        # others can matter and the room is never sorted
+        others = heapq.nlargest(2 * self.k + 1, (key for key in candidates if key not in selected), key=level)
+        for key in others:
+            if len(selected) < self.k:
+                selected.add(key)
+                continue
+            weakest = min(selected, key=level)
+            if level(key) <= level(weakest) + self.hysteresis_db:
+                # the others are quieter still
+                break
+            selected.remove(weakest)
+            selected.add(key)
+        self.selected = selected
+        return selected
+
+    def remove(self, key: Hashable):
+        self.levels.pop(key, None)
+        self.selected.discard(key)
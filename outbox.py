@@ -0,0 +1,152 @@
+import asyncio
+import collections
+import time
+from typing import Any, Dict, List, Optional, Tuple
+from metrics import Counter, Histogram
+
+
+class SendQueue:
+    """
+    Bounded outbound queue of one websocket, drained by its own writer task. When the queue is
+    full the oldest message is dropped, so whoever puts messages never waits on the socket.
+    A listener that keeps falling behind is disconnected after max_drops drops in a row.
+    """
+    def __init__(self, websocket, maxsize: int, max_drops: Optional[int] = None,
+                 bytes_sent: Optional[Counter] = None, send_latency: Optional[Histogram] = None):
+        self.websocket = websocket
+        self.maxsize = maxsize
+        self.max_drops = max_drops
+        self.queue = collections.deque()
+        self.event = asyncio.Event()
+        # number of messages dropped because the listener could not keep up
+        self.dropped = 0
+        self.consecutive_drops = 0
+        self.closed = False
+        self.bytes_sent = bytes_sent
+        self.send_latency = send_latency
+        self.task = asyncio.create_task(self.run())
+
+    def __len__(self):
+        return len(self.queue)
+
+    def put(self, message) -> bool:
+        # queue a message, return False if an older message had to be dropped for it
+        if self.closed:
+            return False
+        dropped = len(self.queue) >= self.maxsize
+        if dropped:
+            self.queue.popleft()
+            self.dropped += 1
+            self.consecutive_drops += 1
+            if self.max_drops is not None and self.consecutive_drops >= self.max_drops:
+                print(f'Disconnect slow client: {self.websocket.remote_address}')
+                self.close()
+                return False
+        self.queue.append((message, time.monotonic()))
+        self.event.set()
+        return not dropped
+
+    async def run(self):
+        try:
+            while True:
+                while len(self.queue) == 0:
+                    self.event.clear()
+                    await self.event.wait()
+                message, put_time = self.queue.popleft()
+                await self.websocket.send(message)
+                if self.bytes_sent is not None:
+                    self.bytes_sent.inc(len(message))
+                if self.send_latency is not None:
+                    self.send_latency.observe(time.monotonic() - put_time)
+                if len(self.queue) == 0:
+                    # the listener caught up
+                    self.consecutive_drops = 0
+        except asyncio.CancelledError:
+            pass
+        except Exception as e:
+            print(f'Send failed to {self.websocket.remote_address}: {e}')
+
+    def stop(self):
+        self.closed = True
+        self.task.cancel()
+        self.queue.clear()
+
+    def close(self):
+        # stop the writer and close the socket, the receive loop of the client then cleans up
+        self.stop()
+        asyncio.ensure_future(self.websocket.close())
+
+
+class LatestFrameMailbox:
+    """
+    Outbound video mailbox of one receiver with one slot per sender, drained by its own writer task.
+    A new frame of a sender replaces the one still waiting in its slot, so a slow receiver gets fewer
+    frames but never stale ones, and no sender ever waits on the socket of a receiver. A delta frame,
+    which only makes sense on top of the latest full frame, replaces the waiting delta but keeps the
+    waiting full frame, and both are sent in order.
+    """
+    def __init__(self, websocket, replaced: Optional[Counter] = None, bytes_sent: Optional[Counter] = None):
+        self.websocket = websocket
+        # sender -> latest messages not sent yet, a full one and/or a delta, in the order the slots were filled
+        self.slots = collections.OrderedDict()
+        self.event = asyncio.Event()
+        self.closed = False
+        self.replaced = replaced
+        self.bytes_sent = bytes_sent
+        # sender -> [messages sent, messages replaced] since the last take_stats, the feedback to the sender
+        self.stats: Dict[Any, List[int]] = {}
+        self.task = asyncio.create_task(self.run())
+
+    def __len__(self):
+        return len(self.slots)
+
+    def pending(self, sender) -> int:
+        # messages of the sender waiting to be sent
+        return len(self.slots.get(sender, ()))
+
+    def take_stats(self, sender) -> Tuple[int, int]:
+        # messages of the sender sent and replaced since the previous call
+        sent, replaced = self.stats.pop(sender, (0, 0))
+        return sent, replaced
+
+    def put(self, sender, message, delta: bool = False) -> bool:
+        # leave the message in the slot of its sender, return False if it replaced an unsent one
+        if self.closed:
+            return False
+        waiting = self.slots.get(sender)
+        replaced = waiting is not None
+        # a replaced frame keeps the place of its slot, so every sender gets its turn
+        if delta and waiting is not None and not waiting[0][1]:
+            # keep the full message the delta applies to
+            replaced = len(waiting) > 1
+            self.slots[sender] = [waiting[0], (message, delta)]
+        else:
+            self.slots[sender] = [(message, delta)]
+        if replaced:
+            self.stats.setdefault(sender, [0, 0])[1] += 1
+            if self.replaced is not None:
+                self.replaced.inc()
+        self.event.set()
+        return not replaced
+
+    async def run(self):
+        try:
+            while True:
+                while len(self.slots) == 0:
+                    self.event.clear()
+                    await self.event.wait()
+                sender, messages = self.slots.popitem(last=False)
+                for message, _ in messages:
+                    await self.websocket.send(message)
+                    self.stats.setdefault(sender, [0, 0])[0] += 1
+                    if self.bytes_sent is not None:
+                        self.bytes_sent.inc(len(message))
+        except asyncio.CancelledError:
+            pass
+        except Exception as e:
+            print(f'Send failed to {self.websocket.remote_address}: {e}')
+
+    def stop(self):
+        self.closed = True
+        self.task.cancel()
+        self.slots.clear()
@@ -0,0 +1,96 @@
+import math
+
+import numpy as np
+
+
+class PitchShifter:
+    """
+    Streaming pitch shifter for the Voice Change slider. Every output grain of window samples, one
+    every window // 2 samples, is read from the input window * factor samples long and resampled to
+    window samples, so the pitch moves by factor and the duration does not change. Like WSOLA, each
+    grain is moved by up to tolerance samples to where it best continues the previous one, which
+    keeps the pitch periods in phase. The window, the grain positions and the input history are kept
+    across chunks, so any chunk size can be fed and the output is delayed by a constant latency.
+    """
+    def __init__(self, window: int = 1024, tolerance: int = 256, max_steps: float = 12):
+        self.window = window
+        self.hop = window // 2
+        self.tolerance = tolerance
+        # periodic Hann window, its copies one hop apart add up to exactly one
+        self.hann = (0.5 - 0.5 * np.cos(2 * np.pi * np.arange(window) / window)).astype(np.float32)
+        self.grain_positions = np.arange(window, dtype=np.float64)
+        self.search_positions = np.arange(self.hop + 2 * tolerance, dtype=np.float64)
+        self.target_positions = np.arange(self.hop, dtype=np.float64)
+        max_factor = 2 ** (max_steps / 12)
+        # the last grain that ends before an output sample needs this much more input after it
+        self.reach = int(math.ceil(window / 2 + window * max_factor / 2 + (tolerance + 1) * max_factor)) + 1
+        self.latency = self.reach + self.hop
+        self.factor = 1.0
+        self.reset()
+
+    def reset(self):
+        # input history, history[0] is the input sample number history_start
+        self.history = np.zeros(self.latency + 2 * self.window, dtype=np.float32)
+        self.history_start = -len(self.history)
+        self.time = 0
+        # overlap-add of the grains, output[0] is the output sample number output_start
+        self.output = np.zeros(self.window, dtype=np.float32)
+        self.output_start = -self.latency
+        self.next_grain = -self.latency
+        # input position the previous grain was read from
+        self.previous_read = None
+
+    def set_steps(self, n_steps: float):
+        self.factor = 2 ** (n_steps / 12)
+
+    def read(self, positions: np.ndarray) -> np.ndarray:
+        # the input at fractional sample numbers, linearly interpolated
+        positions = positions - self.history_start
+        index = positions.astype(np.int64)
+        frac = (positions - index).astype(np.float32)
+        return self.history[index] * (1 - frac) + self.history[index + 1] * frac
+
+    def grain_start(self, start: int) -> float:
+        # input position of the grain at output sample start, moved to continue the previous grain
+        factor = self.factor
+        nominal = start + self.window / 2 - self.window * factor / 2
+        if self.previous_read is None:
+            return nominal
+        # the previous grain would have gone on from here, find the candidate most like it
+        natural = self.previous_read + self.hop * factor
+        target = self.read(natural + self.target_positions * factor)
+        candidates = self.read(nominal - self.tolerance * factor + self.search_positions * factor)
+        correlation = np.correlate(candidates, target, 'valid')
+        return nominal + (int(np.argmax(correlation)) - self.tolerance) * factor
+
+    def process(self, samples: np.ndarray) -> np.ndarray:
+        # shift a chunk of int16 samples, returns as many int16 samples, delayed by latency samples
+        n = len(samples)
+        # the grains of this chunk read back to about latency + window samples before it
+        keep = n + self.latency + 2 * self.window
+        self.history = np.concatenate((self.history, samples.astype(np.float32)))[-keep:]
+        self.time += n
+        self.history_start = self.time - len(self.history)
+
+        # add every grain whose input is all here
+        end = self.time - self.reach
+        grains = max(0, (end - self.next_grain) // self.hop + 1)
+        emit_start = self.time - n - self.latency
+        needed = max(self.next_grain + grains * self.hop + self.window, emit_start + n) - self.output_start
+        if needed > len(self.output):
+            self.output = np.concatenate((self.output, np.zeros(needed - len(self.output), dtype=np.float32)))
+        for _ in range(grains):
+            read = self.grain_start(self.next_grain)
+            grain = self.read(read + self.grain_positions * self.factor)
+            offset = self.next_grain - self.output_start
+            self.output[offset:offset + self.window] += grain * self.hann
+            self.previous_read = read
+            self.next_grain += self.hop
+
+        # the output before the next grain is complete
+        start = emit_start - self.output_start
+        out = self.output[start:start + n]
+        result = np.clip(out, -32768, 32767).astype(np.int16)
+        self.output = self.output[start + n:].copy()
+        self.output_start = emit_start + n
+        return result
@@ -0,0 +1,103 @@
+import struct
+import time
+from typing import NamedTuple, Tuple
+
+PROTOCOL_VERSION = 1
+
+# version, flags, number of samples per mix, sequence number, timestamp in microseconds
+FRAME_HEADER = struct.Struct('!BBHIQ')
+
+# upstream: the client is recording and wants the mix with its own voice
+FLAG_WANT_SELF = 0x01
+# downstream: the mix without self is followed by the mix with self
+FLAG_WITH_SELF = 0x02
+# upstream: the client is muted, the frame has no payload
+FLAG_MUTE = 0x04
+# upstream: the client is silent and sends this marker now and then instead of audio, it has no payload
+FLAG_DTX = 0x08
+# downstream: the frame of one speaker relayed as it is by a forwarding room, the payload starts
+# with the forward header
+FLAG_FORWARDED = 0x10
+
+# id of the speaker in the room and id of the codec of its payload
+FORWARD_HEADER = struct.Struct('!HB')
+# number of speaker ids the forward header can carry
+SPEAKER_IDS = 0x10000
+
+SEQUENCE_MASK = 0xFFFFFFFF
+
+# kinds of video payload: a full JPEG frame, or a JPEG of the region of the frame that differs from
+# the latest full frame, at the offset given by PATCH_HEADER
+KEYFRAME = b'K'
+PATCH = b'P'
+PATCH_HEADER = struct.Struct('!HH')
+
+
+class AudioFrame(NamedTuple):
+    flags: int
+    sample_count: int
+    sequence: int
+    # upstream: capture time of the frame on the sender's monotonic clock
+    # downstream: echo of the timestamp of the latest frame the server received from the listener,
+    # 0 if none, so the listener can measure its round-trip latency on its own clock
+    timestamp: int
+    payload: memoryview
+
+
+def timestamp_now() -> int:
+    return time.monotonic_ns() // 1000
+
+
+def pack_frame(flags: int, sample_count: int, sequence: int, timestamp: int, *payloads: bytes) -> bytes:
+    header = FRAME_HEADER.pack(PROTOCOL_VERSION, flags, sample_count, sequence & SEQUENCE_MASK, timestamp)
+    return b''.join((header,) + payloads)
+
+
+def parse_frame(message: bytes) -> AudioFrame:
+    if len(message) < FRAME_HEADER.size:
+        raise ValueError(f"Audio frame too short: {len(message)} bytes")
+    version, flags, sample_count, sequence, timestamp = FRAME_HEADER.unpack_from(message)
+    if version != PROTOCOL_VERSION:
+        raise ValueError(f"Unsupported audio frame version: {version}")
+    return AudioFrame(flags, sample_count, sequence, timestamp, memoryview(message)[FRAME_HEADER.size:])
+
+
+def pack_forwarded(frame: AudioFrame, sender_id: int, codec_id: int) -> bytes:
+    # the header and payload of the speaker are kept, only the DTX flag of its own flags is relayed
+    return pack_frame(FLAG_FORWARDED | (frame.flags & FLAG_DTX), frame.sample_count, frame.sequence, frame.timestamp,
+                      FORWARD_HEADER.pack(sender_id & 0xFFFF, codec_id), frame.payload)
+
+
+def parse_forwarded(frame: AudioFrame) -> Tuple[int, int, memoryview]:
+    # sender id, codec id and payload of a forwarded frame
+    if len(frame.payload) < FORWARD_HEADER.size:
+        raise ValueError(f"Forwarded audio frame too short: {len(frame.payload)} bytes")
+    sender_id, codec_id = FORWARD_HEADER.unpack_from(frame.payload)
+    return sender_id, codec_id, frame.payload[FORWARD_HEADER.size:]
+
+
+class SequenceTracker:
+    """
+    Follows the sequence numbers of a stream of frames and counts the lost and reordered ones.
+    """
+    def __init__(self):
+        self.expected = None
+        self.received = 0
+        self.lost = 0
+        self.reordered = 0
+
+    def update(self, sequence: int) -> bool:
+        # return False for a frame older than one already received
+        self.received += 1
+        if self.expected is None:
+            self.expected = (sequence + 1) & SEQUENCE_MASK
+            return True
+        gap = (sequence - self.expected) & SEQUENCE_MASK
+        if gap < SEQUENCE_MASK // 2:
+            # the frames in the gap are missing, until they show up late
+            self.lost += gap
+            self.expected = (sequence + 1) & SEQUENCE_MASK
+            return True
+        self.reordered += 1
+        self.lost = max(0, self.lost - 1)
+        return False
@@ -0,0 +1,105 @@
+import asyncio
+import json
+import multiprocessing
+import zlib
+from typing import List, Set
+
+import websockets
+from websockets.legacy.server import WebSocketServerProtocol as Socket
+
+
+def worker_ports(config, index: int):
+    # the audio and video ports of a worker, right after the ports of the supervisor
+    audio_port = config['port'] + 2 + 2 * index
+    return audio_port, audio_port + 1
+
+
+def run_worker(config, index: int):
+    # entry point of a worker process, it serves the rooms the supervisor assigns to it
+    from server import ChatServer
+
+    async def serve():
+        server = ChatServer(config)
+        audio_port, video_port = worker_ports(config, index)
+        tasks = [
+            asyncio.create_task(server.run(config['ip'], audio_port)),
+            asyncio.create_task(server.run2(config['ip'], video_port)),
+        ]
+        if config['metrics_port'] is not None:
+            tasks.append(asyncio.create_task(server.metrics.serve('127.0.0.1', config['metrics_port'] + 1 + index)))
+        await asyncio.gather(*tasks)
+
+    asyncio.run(serve())
+
+
+class RoomRouter:
+    """
+    Supervisor of the multi-worker mode. It keeps the global room registry and assigns every room
+    to one worker process by hashing its name, so the mixer and the video relay of a room always
+    live in the same worker. Clients ask the supervisor for the ports of a room with ROUTE and then
+    connect to the worker directly.
+    """
+    def __init__(self, config):
+        self.config = config
+        self.n_workers = config['workers']
+        self.room_list: Set[str] = set()
+        self.workers: List[multiprocessing.Process] = []
+
+    def owner(self, room_name: str) -> int:
+        # crc32 is stable across processes and runs, unlike hash()
+        return zlib.crc32(room_name.encode('utf-8')) % self.n_workers
+
+    def start_workers(self):
+        for index in range(self.n_workers):
+            worker = multiprocessing.Process(target=run_worker, args=(self.config, index), daemon=True)
+            worker.start()
+            self.workers.append(worker)
+
+    async def forward(self, room_name: str, action: str) -> str:
+        # send a room command to the worker that owns the room and return its response
+        audio_port, _ = worker_ports(self.config, self.owner(room_name))
+        uri = f"ws://{self.config['ip']}:{audio_port}"
+        for attempt in range(10):
+            try:
+                async with websockets.connect(uri) as websocket:
+                    await websocket.send(action)
+                    return await websocket.recv()
+            except OSError:
+                # the worker may still be starting
+                await asyncio.sleep(0.2)
+        return f"Worker of room {room_name} is not available."
+
+    async def handler(self, websocket: Socket, path):
+        action = await websocket.recv()
+        if isinstance(action, bytes):
+            action = action.decode('utf-8')
+
+        if action == "LIST":
+            await websocket.send(",".join(self.room_list))
+        elif action.startswith("ROUTE"):
+            room_name = action.split()[1]
+            audio_port, video_port = worker_ports(self.config, self.owner(room_name))
+            await websocket.send(json.dumps({"audio_port": audio_port, "video_port": video_port}))
+        elif action.startswith("CREATE"):
+            room_name = action.split()[1]
+            response = await self.forward(room_name, action)
+            if response == f"Room {room_name} created.":
+                self.room_list.add(room_name)
+            await websocket.send(response)
+        elif action.startswith("MODE"):
+            room_name = action.split()[1]
+            await websocket.send(await self.forward(room_name, action))
+        elif action.startswith("DELETE"):
+            room_name = action.split()[1]
+            response = await self.forward(room_name, action)
+            self.room_list.discard(room_name)
+            await websocket.send(response)
+        else:
+            # audio must go to the worker of the room, the client has to ask for the route first
+            print(f"Join of room {action} received by the supervisor, ROUTE it first.")
+
+    async def run(self, host, port):
+        self.start_workers()
+        async with websockets.serve(self.handler, host, port):
+            print(f"Supervisor started at ws://{host}:{port} with {self.n_workers} workers")
+            await asyncio.Future()  # run forever
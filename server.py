@@ -1,22 +1,99 @@
 import asyncio
+import collections
 import websockets
 import sys
 from config import config
-from typing import List, Dict, Set, Optional, Any
+from typing import List, Dict, Set, Optional, Any, Tuple
 import numpy as np
 import time
 from websockets.legacy.server import WebSocketServerProtocol as Socket
 import json
+from concurrent.futures import ThreadPoolExecutor
+from mixer import ActiveSpeakerSelector, MixMinusEngine
+from audio_buffer import JitterBuffer
+from outbox import LatestFrameMailbox, SendQueue
+from metrics import MetricsRegistry, TIME_BUCKETS, DEPTH_BUCKETS
+from router import RoomRouter
+from codec import Codec, CODECS, negotiate
+from protocol import FLAG_DTX, FLAG_MUTE, FLAG_WANT_SELF, FLAG_WITH_SELF, PATCH, SPEAKER_IDS, AudioFrame, SequenceTracker, pack_forwarded, pack_frame, parse_frame
+
+
+class RoomMetrics:
+    # handles on the metrics of one room, so that the hot path does not look them up by label
+    def __init__(self, metrics: MetricsRegistry, room_name: str):
+        self.mix_duration = metrics.histogram(
+            'audio_mix_duration_seconds', 'Time spent mixing and queueing one tick of audio.', TIME_BUCKETS, room=room_name)
+        self.buffer_depth = metrics.histogram(
+            'audio_buffer_depth_chunks', 'Depth of the jitter buffers at each tick.', DEPTH_BUCKETS, room=room_name)
+        self.send_latency = metrics.histogram(
+            'audio_send_latency_seconds', 'Time a mixed chunk waits in the send queue.', TIME_BUCKETS, room=room_name)
+        self.bytes_in = metrics.counter('audio_received_bytes_total', 'Audio bytes received from clients.', room=room_name)
+        self.bytes_out = metrics.counter('audio_sent_bytes_total', 'Audio bytes sent to clients.', room=room_name)
+        self.dropped_chunks = metrics.counter(
+            'audio_dropped_chunks_total', 'Mixed chunks dropped because a client was too slow.', room=room_name)
+        self.lost_frames = metrics.counter(
+            'audio_lost_frames_total', 'Frames from clients that never arrived.', room=room_name)
+        self.reordered_frames = metrics.counter(
+            'audio_reordered_frames_total', 'Frames from clients that arrived too late and were dropped.', room=room_name)
+        self.video_bytes_out = metrics.counter('video_sent_bytes_total', 'Video bytes sent to clients.', room=room_name)
+        self.video_replaced_frames = metrics.counter(
+            'video_replaced_frames_total', 'Video frames replaced by a newer one before a slow client got them.', room=room_name)
+
+
+# the server mixes the audio of the room, or it only forwards the frames of each speaker and the clients mix them
+MIX_MODE = 'mix'
+FORWARD_MODE = 'forward'
+ROOM_MODES = (MIX_MODE, FORWARD_MODE)
+
+# slot of the congestion feedback in the video mailbox of a client, the other slots are named after senders
+FEEDBACK_SLOT = None
+
+
+class AudioClient:
+    # state of the audio protocol of one connection
+    def __init__(self, codec: Codec, client_id: int):
+        self.codec = codec
+        # tags the frames of the client forwarded to the others
+        self.id = client_id
+        # True while the client is recording and wants the mix with its own voice
+        self.want_self = False
+        # capture timestamp of the latest frame received from the client, echoed back in its frames
+        self.last_timestamp = 0
+        # sequence number of the next frame sent to the client
+        self.sequence = 0
+        # sequence numbers of the frames received from the client
+        self.upstream = SequenceTracker()
+        # True while the client is silent and sends DTX markers instead of audio
+        self.dtx = False
 
 
 class ChatServer:
     def __init__(self, config):
         # Maps room names to sets of websockets.
         self.rooms: Dict[str, Set[Socket]] = {}
-        # Maps room names to dict of user_id to audio chunks
-        self.audio_buffers: Dict[str, Dict[Socket, asyncio.Queue]] = {}
+        # Maps room names to dict of user_id to an adaptive jitter buffer of audio samples
+        self.audio_buffers: Dict[str, Dict[Socket, JitterBuffer]] = {}
         # Maps room names to an asyncio task that do audio mixing
         self.mixing_tasks: Dict[str, Any] = {}
+        # Maps room names to an event that is set whenever something arrives for the mixer
+        self.audio_arrivals: Dict[str, asyncio.Event] = {}
+        # Maps room names to the engine that mixes the audio of the room
+        self.mixers: Dict[str, MixMinusEngine] = {}
+        # Maps room names to MIX_MODE or FORWARD_MODE
+        self.room_modes: Dict[str, str] = {}
+        # Maps room names to the selector of the loudest clients, None if the room mixes everyone
+        self.speaker_selectors: Dict[str, Optional[ActiveSpeakerSelector]] = {}
+        # Maps each audio client to the state of its audio stream, including the codec negotiated when it joined
+        self.audio_clients: Dict[Socket, AudioClient] = {}
+        # ids of the clients fit in the forward header, so the ids of the clients that left are reused,
+        # the one freed longest ago first, once every id has been given out
+        self.next_client_id = 0
+        self.free_client_ids = collections.deque()
+        # Maps each audio client to its outbound queue, drained by its own writer task
+        self.audio_outboxes: Dict[Socket, SendQueue] = {}
+        # Counters and histograms of the server, and handles on the metrics of each room
+        self.metrics = MetricsRegistry()
+        self.room_metrics: Dict[str, RoomMetrics] = {}
         self.room_list: Set[str] = set()  # Maintain a list of all rooms
         # Dict of muted clients in each room
         self.muted_clients: Dict[str, List[Socket]] = {}
@@ -25,12 +102,39 @@ class ChatServer:
         self.video_buffers: Dict[str, Dict[Socket, bytes]] = {}
         self.video_broadcast_tasks: Dict[str, Any] = {}
         self.socket_name_mapping: Dict[str, Socket] = {}
+        # Maps each video client to its mailbox of the latest frame of every sender, drained by its own writer task
+        self.video_mailboxes: Dict[Socket, LatestFrameMailbox] = {}
+        # Maps each video client to its latest keyframe, sent to the clients that join after it
+        self.video_keyframes: Dict[Socket, Tuple[str, bytes]] = {}
+        # seconds between two reports to a video sender of how its receivers keep up
+        self.video_feedback_interval = config["video_feedback_interval"]
+        # ports the audio and video servers listen on, reported to clients by ROUTE
+        self.audio_port: Optional[int] = None
+        self.video_port: Optional[int] = None
 
         # set self.audio_chunk_size to the size of each audio chunk in bytes
         self.audio_chunk_size = config['chunk_size'] * config['channel'] * 2  # 2 bytes per sample
+        self.chunk_samples = config['chunk_size'] * config['channel']
         self.chunk_duration = config['chunk_size'] / config['rate']
+        # bounds (in chunks) of the depth of the jitter buffers
+        self.min_buffer_size = config["min_buffer_size"]
         self.max_buffer_size = config["max_buffer_size"]
         self.amplification_factor = config["amplification_factor"]
+        # number of loudest clients mixed in rooms created without a topk option, None to mix everyone
+        self.topk = config["topk"]
+        self.send_queue_size = config["send_queue_size"]
+        # optionally run the mixing math in a thread pool, only the socket I/O stays on the event loop
+        # a room has at most one mix in flight, so its ticks stay in order
+        self.mix_executor = ThreadPoolExecutor(config["mix_threads"]) if config["mix_in_executor"] else None
+        # print a trace of every tick, far too slow for production
+        self.debug = config["debug"]
+        self.max_send_drops = config["max_send_drops"]
+        # shared payloads sent to everyone when there is nothing to mix, one per codec
+        self.silence_payloads: Dict[str, bytes] = {
+            name: codec.encode(np.zeros(self.chunk_samples, dtype=np.int16)) for name, codec in CODECS.items()
+        }
+        # engine used by mix_audio, the rooms have their own engines
+        self.mix_engine = MixMinusEngine(self.chunk_samples, self.amplification_factor)
    
     async def handler(self, websocket: Socket, path):
         message = await websocket.recv()
@@ -46,13 +150,28 @@ class ChatServer:
         if action == "LIST":
             await websocket.send(",".join(self.room_list))
             return  
+        elif action.startswith("ROUTE"):
+            # a single server owns every room
+            await websocket.send(json.dumps({"audio_port": self.audio_port, "video_port": self.video_port}))
+            return
         elif action.startswith("CREATE"):
+            # CREATE <room> [topk=<k>] [mode=mix|forward]
             room_name = action.split()[1]
-            if room_name not in self.rooms:
+            options = dict(option.split("=", 1) for option in action.split()[2:] if "=" in option)
+            topk = int(options["topk"]) if "topk" in options else self.topk
+            mode = options.get("mode", MIX_MODE)
+            if mode not in ROOM_MODES:
+                await websocket.send(f"Unknown audio mode {mode}.")
+            elif room_name not in self.rooms:
                 self.rooms[room_name]: Set[Socket] = set()
                 self.rooms2[room_name]: Set[Socket] = set()
                 self.audio_buffers[room_name] = {}
                 self.muted_clients[room_name] = []
+                self.audio_arrivals[room_name] = asyncio.Event()
+                self.mixers[room_name] = MixMinusEngine(self.chunk_samples, self.amplification_factor)
+                self.speaker_selectors[room_name] = ActiveSpeakerSelector(topk) if topk else None
+                self.room_modes[room_name] = mode
+                self.room_metrics[room_name] = RoomMetrics(self.metrics, room_name)
                 self.mixing_tasks[room_name] = asyncio.create_task(self.mix_and_broadcast(room_name))
                 # self.video_buffers[room_name] = {}
                 # self.video_broadcast_tasks[room_name] = asyncio.create_task(self.broadcast_video(room_name))
@@ -61,6 +180,17 @@ class ChatServer:
             else:
                 await websocket.send(f"Room {room_name} already exists.")
             return  
+        elif action.startswith("MODE"):
+            # MODE <room> mix|forward, the clients in the room stay connected
+            room_name, mode = action.split()[1:3]
+            if room_name not in self.rooms:
+                await websocket.send("Room not found.")
+            elif mode not in ROOM_MODES:
+                await websocket.send(f"Unknown audio mode {mode}.")
+            else:
+                self.set_room_mode(room_name, mode)
+                await websocket.send(f"Room {room_name} switched to {mode} mode.")
+            return
         elif action.startswith("DELETE"):
             room_name = action.split()[1]
             if room_name in self.rooms:
@@ -74,8 +204,29 @@ class ChatServer:
         #     if room_name in self.rooms and websocket in self.rooms[room_name]:
         #         self.rooms[room_name].remove(websocket)
         #         print(f"Client disconnected from room: {room_name}.")
+        elif action.startswith("{"):
+            # join request with the codecs the client supports, reply with the one picked by the server
+            request = json.loads(action)
+            codec = negotiate(request.get("codecs", []))
+            client_id = self.allocate_client_id()
+            if client_id is None:
+                await websocket.send("Server full.")
+                return
+            await websocket.send(json.dumps({
+                "codec": codec.name, "id": client_id, "mode": self.room_modes.get(request["room"], MIX_MODE)
+            }))
+            await self.handle_join(websocket, request["room"], codec, client_id)
         else:
-            await self.handle_join(websocket, action)
+            # a plain room name from a client that does not frame its audio, refuse it before it sends any
+            await websocket.send("Unsupported join request, send the room and codecs as JSON.")
+
+    def allocate_client_id(self) -> Optional[int]:
+        if self.next_client_id < SPEAKER_IDS:
+            self.next_client_id += 1
+            return self.next_client_id - 1
+        if self.free_client_ids:
+            return self.free_client_ids.popleft()
+        return None
 
     async def handler2(self, websocket: Socket, path):
         message = await websocket.recv()
@@ -87,24 +238,38 @@ class ChatServer:
         else:
             await self.handle_join2(websocket, message)
 
-    async def handle_join(self, websocket: Socket, room_name: str):
+    async def handle_join(self, websocket: Socket, room_name: str, codec: Codec = CODECS['pcm'], client_id: int = 0):
         if room_name not in self.rooms:
             self.rooms[room_name]: Set[Socket] = set()
             self.audio_buffers[room_name] = {}
             self.muted_clients[room_name] = []
+            self.audio_arrivals[room_name] = asyncio.Event()
+            self.mixers[room_name] = MixMinusEngine(self.chunk_samples, self.amplification_factor)
+            self.speaker_selectors[room_name] = ActiveSpeakerSelector(self.topk) if self.topk else None
+            self.room_modes[room_name] = MIX_MODE
+            self.room_metrics[room_name] = RoomMetrics(self.metrics, room_name)
             self.mixing_tasks[room_name] = asyncio.create_task(self.mix_and_broadcast(room_name))
             self.room_list.add(room_name)  # Add the room name to the room list
+            self.free_client_ids.append(client_id)
             raise Exception('This condition should not be reached')
 
+        # the mixer never sends to the socket directly, it only puts the mixed audio in the queue
+        room_metrics = self.room_metrics[room_name]
+        client = AudioClient(codec, client_id)
+        self.audio_clients[websocket] = client
+        self.audio_outboxes[websocket] = SendQueue(
+            websocket, self.send_queue_size, self.max_send_drops, room_metrics.bytes_out, room_metrics.send_latency
+        )
         self.rooms[room_name].add(websocket)
+        self.resize_outboxes(room_name)
 
-        # clear up existing audio chunks in all buffers in the room
-        for queue in self.audio_buffers[room_name].values():
-            while not queue.empty():
-                queue.get_nowait()
-
-        # then add new audio buffer for the new client
-        self.audio_buffers[room_name][websocket] = asyncio.Queue()
+        # add new audio buffer for the new client
+        # every client has its own jitter buffer, so the other clients in the room are not disturbed
+        self.audio_buffers[room_name][websocket] = JitterBuffer(
+            self.chunk_samples, self.chunk_duration, self.min_buffer_size, self.max_buffer_size
+        )
+        # wake up the mixer in case the room was idle
+        self.audio_arrivals[room_name].set()
 
         self.print_status()
 
@@ -116,38 +281,76 @@ class ChatServer:
                 audio_chunk = await websocket.recv()
                 # audio_after_receive = time.time()
                 # print(f'Audio receive time: {audio_after_receive - audio_before_receive}')
-                if isinstance(audio_chunk, bytes):
+                room_metrics.bytes_in.inc(len(audio_chunk))
+                frame = parse_frame(audio_chunk)
+                lost = client.upstream.lost
+                if not client.upstream.update(frame.sequence):
+                    # the audio after this frame is already buffered
+                    room_metrics.reordered_frames.inc()
+                    continue
+                room_metrics.lost_frames.inc(client.upstream.lost - lost)
+                client.want_self = bool(frame.flags & FLAG_WANT_SELF)
+                client.last_timestamp = frame.timestamp
+
+                if not frame.flags & FLAG_MUTE:
                     if websocket in self.muted_clients[room_name]:
                         # previously the client is muted, then unmute the client
                         self.remove_client_from_mutelist(room_name, websocket)
-                        #self.print_status()
-                    self.audio_buffers[room_name][websocket].put_nowait(audio_chunk)
+                    if self.room_modes[room_name] == FORWARD_MODE:
+                        # relay the frame as it is, the same bytes to every listener, the mixer is not woken up
+                        client.dtx = bool(frame.flags & FLAG_DTX)
+                        self.forward_audio(room_name, websocket, frame)
+                        continue
+                    if frame.flags & FLAG_DTX:
+                        # the client is silent, the mixer skips it once its buffered audio is played out
+                        if not client.dtx:
+                            client.dtx = True
+                            self.audio_buffers[room_name][websocket].pause()
+                    else:
+                        client.dtx = False
+                        samples = codec.decode(frame.payload)[:frame.sample_count]
+                        self.audio_buffers[room_name][websocket].put(samples, asyncio.get_running_loop().time())
+                        if self.speaker_selectors[room_name] is not None:
+                            # measured on arrival, so the selection is ready before the chunk is played
+                            self.speaker_selectors[room_name].update(websocket, samples)
                 else:
-                    assert audio_chunk == 'MUTE', f"Invalid message received: {audio_chunk}, {type(audio_chunk)}"
-                    # if MUTE is received, add the client to the muted list
+                    # if the client is muted, add it to the muted list
                     if websocket not in self.muted_clients[room_name]:
                         self.muted_clients[room_name].append(websocket)
                         # clean up the corresponding audio buffer
-                        while not self.audio_buffers[room_name][websocket].empty():
-                            self.audio_buffers[room_name][websocket].get_nowait()
-                        #self.print_status()
+                        self.audio_buffers[room_name][websocket].reset()
+                        if self.room_modes[room_name] == FORWARD_MODE:
+                            # the listeners pause the speaker like for a DTX marker, so the frames not
+                            # forwarded while muted do not look lost
+                            self.forward_audio(room_name, websocket, frame._replace(flags=FLAG_DTX))
+                self.audio_arrivals[room_name].set()
                 await asyncio.sleep(0)
                 # audio_after_put = time.time()
                 # print(f'Audio put time: {audio_after_put - audio_after_receive}')
         except Exception as e:
             print(f"except{e}:Client disconnected from {room_name}.")
         finally:
-            if websocket in self.rooms[room_name]:
-                self.rooms[room_name].remove(websocket)
-            if websocket in self.audio_buffers[room_name]:
-                del self.audio_buffers[room_name][websocket]
-            if websocket in self.muted_clients[room_name]:
-                self.muted_clients[room_name].remove(websocket)
-
-            if len(self.rooms[room_name]) == 0:
-                print(f"No clients left in room: {room_name}, but the room remains until explicitly deleted.")
+            # the state of the client first, the room may have been deleted while the client was in it
+            if websocket in self.audio_outboxes:
+                self.audio_outboxes.pop(websocket).stop()
+            self.audio_clients.pop(websocket, None)
+            self.free_client_ids.append(client.id)
+
+            if room_name not in self.rooms:
+                print(f"Client disconnected from {room_name}, which was deleted.")
             else:
-                print(f"Client disconnected from {room_name}. Total clients in room: {len(self.rooms[room_name])}")
+                self.rooms[room_name].discard(websocket)
+                self.audio_buffers[room_name].pop(websocket, None)
+                if websocket in self.muted_clients[room_name]:
+                    self.muted_clients[room_name].remove(websocket)
+                if self.speaker_selectors[room_name] is not None:
+                    self.speaker_selectors[room_name].remove(websocket)
+                self.resize_outboxes(room_name)
+
+                if len(self.rooms[room_name]) == 0:
+                    print(f"No clients left in room: {room_name}, but the room remains until explicitly deleted.")
+                else:
+                    print(f"Client disconnected from {room_name}. Total clients in room: {len(self.rooms[room_name])}")
             self.print_status()
 
     async def handle_join2(self, websocket: Socket, message: str):
@@ -155,9 +358,20 @@ class ChatServer:
         room_name = data['room']
         client_name = data['user']
         self.socket_name_mapping[client_name] = websocket
+        # the frames for this client wait in its mailbox, one per sender, until its writer task sends them
+        room_metrics = self.room_metrics[room_name]
+        self.video_mailboxes[websocket] = LatestFrameMailbox(
+            websocket, room_metrics.video_replaced_frames, room_metrics.video_bytes_out
+        )
+        # the latest keyframe of everyone already in the room, their next patches apply to it
+        for socket in self.rooms2[room_name]:
+            if socket in self.video_keyframes:
+                self.send_video(websocket, *self.video_keyframes[socket])
         self.rooms2[room_name].add(websocket)
         # self.video_buffers[room_name][websocket] = b''
         print(f"New client connected to {room_name}. Total clients in room: {len(self.rooms[room_name])}")
+        sender = b'V' + client_name.encode('utf-8')
+        feedback_task = asyncio.create_task(self.send_video_feedback(room_name, websocket, client_name))
 
         try:
             while websocket in self.rooms2[room_name]:
@@ -167,176 +381,274 @@ class ChatServer:
                 # print(f'Video receive time: {video_after_receive - video_before_receive}')
                 if message[:5] != b'VIDEO':
                     print(f"Invalid message received: {message[:10]}")
-                # video_before_send_time = time.time()
-                # for socket in self.rooms2[room_name]:
-                for socket in self.rooms2[room_name].copy():
+                # build the outgoing frame once, every receiver gets the same bytes
+                frame = b''.join((sender, memoryview(message)[5:]))
+                # a patch only carries the region that differs from the latest keyframe of the sender
+                delta = message[5:6] == PATCH
+                if not delta:
+                    self.video_keyframes[websocket] = (client_name, frame)
+                for socket in self.rooms2[room_name]:
                     if socket != websocket:
-                        try:
-                            await socket.send(b'V' + client_name.encode('utf-8') + message[5:])
-                        except Exception as e:
-                            print(f"here333except{e}",client_name)
-                # video_after_send_time = time.time()
-                # print(f'Video send time: {video_after_send_time - video_before_send_time}')
+                        self.send_video(socket, client_name, frame, delta)
         except Exception as e:
             print(f"handler2except{e}:Client disconnected from {room_name}.")
         finally:
-            for socket in self.rooms2[room_name].copy():
-                if socket != websocket:
-                    print("here4")
-                    try:
-                        await socket.send(b'X' + client_name.encode('utf-8'))
-                    except Exception as e:
-                        print(f"here444except{e}",client_name)
+            feedback_task.cancel()
             if websocket in self.rooms2[room_name]:
                 self.rooms2[room_name].remove(websocket)
+            if websocket in self.video_mailboxes:
+                self.video_mailboxes.pop(websocket).stop()
+            self.video_keyframes.pop(websocket, None)
+            # the leave notice takes the slot of the last frame of the client, which is obsolete anyway
+            leave = b'X' + client_name.encode('utf-8')
+            for socket in self.rooms2[room_name]:
+                self.send_video(socket, client_name, leave)
             if len(self.rooms2[room_name]) == 0:
                 print(f"No clients left in room: {room_name}, but the room remains until explicitly deleted.")
             else:
                 print(f"Client disconnected from {room_name}. Total clients in room: {len(self.rooms2[room_name])}")
 
+    async def send_video_feedback(self, room_name: str, websocket: Socket, client_name: str):
+        # tell a video sender how its receivers kept up with its frames, it adapts its quality and frame rate
+        while True:
+            await asyncio.sleep(self.video_feedback_interval)
+            receivers = 0
+            sent = 0
+            replaced = 0
+            worst_replaced = 0.0
+            depth = 0
+            for socket in self.rooms2[room_name]:
+                if socket == websocket or socket not in self.video_mailboxes:
+                    continue
+                mailbox = self.video_mailboxes[socket]
+                receiver_sent, receiver_replaced = mailbox.take_stats(client_name)
+                receivers += 1
+                sent += receiver_sent
+                replaced += receiver_replaced
+                if receiver_sent + receiver_replaced > 0:
+                    worst_replaced = max(worst_replaced, receiver_replaced / (receiver_sent + receiver_replaced))
+                # frames of this sender still waiting for the receiver
+                depth = max(depth, mailbox.pending(client_name))
+            report = {"receivers": receivers, "sent": sent, "replaced": replaced,
+                      "worst_replaced": worst_replaced, "depth": depth}
+            self.send_video(websocket, FEEDBACK_SLOT, b'F' + json.dumps(report).encode('utf-8'))
+
+    def send_video(self, client: Socket, sender_name: str, message: bytes, delta: bool = False):
+        # leave the message in the mailbox of the client without waiting, it replaces the unsent frame of the same sender,
+        # or only its unsent patch for a patch
+        if client in self.video_mailboxes:
+            self.video_mailboxes[client].put(sender_name, message, delta)
+
     def delete_room(self, room_name: str):
         self.mixing_tasks[room_name].cancel()
         del self.rooms[room_name]
         del self.audio_buffers[room_name]
         del self.mixing_tasks[room_name]
         del self.muted_clients[room_name]
+        del self.audio_arrivals[room_name]
+        del self.mixers[room_name]
+        del self.speaker_selectors[room_name]
+        del self.room_modes[room_name]
+        del self.room_metrics[room_name]
+        self.metrics.remove(room=room_name)
         self.room_list.remove(room_name)
 
-    def check_synchronization(self, room_name: str):
-        print(f'Check synchronization in room: {room_name}')
-        # check if any buffer stores too many audio chunks that cause synchronization issue
-        buffer_sizes = [buffer.qsize() for buffer in self.audio_buffers[room_name].values()]
-        tolerance_duration = 0.1  # 100 ms
-        tolerance_n_chunk = int(tolerance_duration / self.chunk_duration)
-        if max(buffer_sizes) - min(buffer_sizes) > tolerance_n_chunk:
-            print(f"Not synchronized!!!!!!!, now all sync to {min(buffer_sizes)}")
-            # cut the audio chunks in the buffer to the min number of chunks
-            min_buffer_size = min(buffer_sizes)
-            for buffer in self.audio_buffers[room_name].values():
-                while buffer.qsize() > min_buffer_size:
-                    buffer.get_nowait()
+    def all_clients_ready(self, room_name: str) -> bool:
+        # True if every unmuted client in the room has an audio chunk ready to be played,
+        # silent clients send nothing and are not waited for
+        return all(
+            buffer.ready()
+            for usr, buffer in self.audio_buffers[room_name].items()
+            if usr not in self.muted_clients[room_name] and not self.audio_clients[usr].dtx
+        )
+
+    async def wait_for_next_tick(self, room_name: str, deadline: float):
+        # wait until every unmuted client has delivered its chunk or the deadline is reached,
+        # whichever comes first, so that a late client never stalls the whole room
+        loop = asyncio.get_running_loop()
+        arrival = self.audio_arrivals[room_name]
+        # never mix more than one tick ahead of the clock
+        earliest = deadline - self.chunk_duration
+        if earliest > loop.time():
+            await asyncio.sleep(earliest - loop.time())
+        while not self.all_clients_ready(room_name):
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            arrival.clear()
+            try:
+                await asyncio.wait_for(arrival.wait(), timeout)
+            except asyncio.TimeoutError:
+                break
 
     async def mix_and_broadcast(self, room_name: str):
+        loop = asyncio.get_running_loop()
+        arrival = self.audio_arrivals[room_name]
+        deadline = loop.time() + self.chunk_duration
         while True:
             try:
-                print(f'{time.time()}\tbefore: ', end='')
-                self.print_status()
-
-                # wait until all the buffers in the room exceed the max buffer size, except the muted clients
-                while True:
-                    # empty all the buffer for synchronization every 10 second
-                    if time.time() % 10 < 0.01:
-                        self.check_synchronization(room_name)
-
-                    if len(self.rooms[room_name]) > 0:
-                        if all(
-                            buffer.qsize() >= self.max_buffer_size
-                            for usr, buffer in self.audio_buffers[room_name].items()
-                            if usr not in self.muted_clients[room_name]
-                        ):
-                            break
-                    await asyncio.sleep(0.01)
-
-                print(f'{time.time()}\tafter checking buffer size: ', end='')
-                self.print_status()
-
-                # load self.max_buffer_size of audio chunks from the buffers, except the muted clients
-                audio_chunks: Dict[Socket, List[bytes]] = {}
+                if len(self.rooms[room_name]) == 0 or self.room_modes[room_name] == FORWARD_MODE:
+                    # nobody in the room or the clients mix the audio themselves,
+                    # sleep until a client joins or the room switches back to mix mode
+                    arrival.clear()
+                    await arrival.wait()
+                    deadline = loop.time() + self.chunk_duration
+                    continue
+
+                await self.wait_for_next_tick(room_name, deadline)
+                deadline += self.chunk_duration
+                if deadline < loop.time():
+                    # the mixer fell behind the clock, restart the schedule from now
+                    deadline = loop.time() + self.chunk_duration
+
+                tick_start = time.perf_counter()
+                room_metrics = self.room_metrics[room_name]
+                # load one audio chunk from every ready jitter buffer straight into the mixer, except the muted clients
+                # late clients are left out of the mix, which is the same as mixing silence for them
+                mixer = self.mixers[room_name]
+                mixer.reset()
+                mixed_clients: List[Socket] = []
+                candidates: List[Tuple[Socket, JitterBuffer]] = []
                 for client, buffer in self.audio_buffers[room_name].items():
-                    if client not in self.muted_clients[room_name]:
-                        audio_chunks[client] = [buffer.get_nowait() for _ in range(self.max_buffer_size)]
-
-                print(f'{time.time()}\tafter readout: ', end='')
-                self.print_status()
-
-                if len(audio_chunks) == 0:
-                    # everyone is muted, no need to mix audio
+                    if client in self.muted_clients[room_name]:
+                        continue
+                    if self.audio_clients[client].dtx and not buffer.ready():
+                        # silent client with nothing left to play, it gets no row in the mixer
+                        continue
+                    room_metrics.buffer_depth.observe(len(buffer) / self.chunk_samples)
+                    candidates.append((client, buffer))
+
+                selector = self.speaker_selectors[room_name]
+                if selector is not None:
+                    # only the k loudest clients are mixed, so the cost of a tick grows with k and not with the room
+                    selected = selector.select([client for client, buffer in candidates if buffer.ready()])
+                for client, buffer in candidates:
+                    if selector is not None and client not in selected:
+                        # the chunk is played out without being mixed, the listeners hear the mix of the selected
+                        buffer.skip()
+                        continue
+                    samples = buffer.get()
+                    if samples is not None:
+                        mixer.load(samples)
+                        mixed_clients.append(client)
+
+                if len(mixed_clients) == 0:
+                    # everyone is muted, silent or late, no need to mix audio
                     # send empty audio chunks to all clients
-                    print(f'Everyone is muted in room: {room_name}')
+                    if self.debug:
+                        print(f'{time.time()}\tNo audio to mix in room: {room_name}')
                     for client in self.rooms[room_name]:
-                        await client.send(b'\x00' * self.audio_chunk_size)
-                    await asyncio.sleep(self.chunk_duration)
+                        state = self.audio_clients[client]
+                        silence = self.silence_payloads[state.codec.name]
+                        self.send_mix(room_name, client, silence, silence if state.want_self else None)
                 else:
                     # broadcast the audio chunks to all clients in the room, including the muted clients
-                    # joint list of bytes to a byte array for each client
-                    for client in audio_chunks.keys():
-                        audio_chunks[client]: Dict[Socket, bytes] = b''.join(audio_chunks[client])
-                        # convert bytes to numpy array
-                        audio_chunks[client] = np.frombuffer(audio_chunks[client], dtype=np.int16)
-                        # convert to int32 to avoid overflow
-                        audio_chunks[client] = audio_chunks[client].astype(np.int32)
-                        print(f'!!!Client: {client.remote_address}, audio_chunks: {audio_chunks[client].shape}')
-
-                    mixed_chunk = np.sum([audio_chunks[client] for client in audio_chunks.keys()], axis=0)
-                    # print(f'!!!Mixed chunk with self: {mixed_chunk.shape}, {np.sum(mixed_chunk)}')
-
-                    # amplify the mixed data
-                    mixed_chunk_byte = np.clip(mixed_chunk * self.amplification_factor, -32768, 32767).astype(np.int16).tobytes()
-                    # before_send = time.time()
-                    for client in self.rooms[room_name]:
-                        mixed_chunk_without_self = mixed_chunk
-                        if client in audio_chunks.keys():
-                            # remove the client's own audio chunk from the mixed chunk
-                            mixed_chunk_without_self = mixed_chunk - audio_chunks[client]
-
-                        # amplify the mixed data
-                        mixed_chunk_without_self_byte = np.clip(mixed_chunk_without_self * self.amplification_factor, -32768, 32767).astype(np.int16).tobytes()
-
-                        await client.send(mixed_chunk_byte + mixed_chunk_without_self_byte)
-
-                        if np.sum(mixed_chunk_without_self) == 0:
-                            print(f'{time.time()}\tSend empty audio to Client: {client.remote_address}')
-                        else:
-                            print(f'{time.time()}\tSend non-empty audio to Client: {client.remote_address}')
-
-                        # after_send = time.time()
-                        # print(f'Audio send time: {after_send - before_send}')
+                    listeners = [
+                        (client, self.audio_clients[client].codec, self.audio_clients[client].want_self)
+                        for client in self.rooms[room_name]
+                    ]
+                    if self.mix_executor is not None:
+                        # NumPy releases the GIL, so the loop keeps serving sockets while the room is mixed
+                        messages = await loop.run_in_executor(
+                            self.mix_executor, self.encode_mixes, mixer, mixed_clients, listeners
+                        )
+                    else:
+                        messages = self.encode_mixes(mixer, mixed_clients, listeners)
+                    for client, (without_self, with_self) in messages.items():
+                        self.send_mix(room_name, client, without_self, with_self)
+                    if self.debug:
+                        print(f'{time.time()}\tMixed {len(mixed_clients)} clients in room: {room_name}')
+                room_metrics.mix_duration.observe(time.perf_counter() - tick_start)
             except Exception as e:
                 print(f'error found: {e}', file=sys.stderr)
 
+    def encode_mixes(self, mixer: MixMinusEngine, mixed_clients: List[Socket],
+                     listeners: List[Tuple[Socket, Codec, bool]]) -> Dict[Socket, Tuple[bytes, Optional[bytes]]]:
+        # mix the loaded chunks and encode, for every listener, the mix without self and, if the
+        # listener is recording, the mix with self
+        # this may run in the mixing executor, so it only touches its arguments
+        rows, silent = mixer.mix_rows()
+        # clients whose voice is not in the mix hear the full mix, row 0
+        row_of = {client: i + 1 for i, client in enumerate(mixed_clients) if not silent[i]}
+
+        # every distinct (codec, row) is encoded once and shared by the listeners that get it
+        needed: Dict[Codec, Set[int]] = {}
+        for client, codec, want_self in listeners:
+            rows_needed = needed.setdefault(codec, set())
+            rows_needed.add(row_of.get(client, 0))
+            if want_self:
+                rows_needed.add(0)
+        encoded: Dict[Tuple[Codec, int], bytes] = {}
+        for codec, row_set in needed.items():
+            row_list = sorted(row_set)
+            for row, data in zip(row_list, codec.encode_rows(rows[row_list])):
+                encoded[codec, row] = data
+
+        return {
+            client: (encoded[codec, row_of.get(client, 0)], encoded[codec, 0] if want_self else None)
+            for client, codec, want_self in listeners
+        }
+
+    def send_mix(self, room_name: str, client: Socket, without_self: bytes, with_self: Optional[bytes]):
+        state = self.audio_clients.get(client)
+        if state is None:
+            # the client left while its mix was computed
+            return
+        if with_self is None:
+            message = pack_frame(0, self.chunk_samples, state.sequence, state.last_timestamp, without_self)
+        else:
+            message = pack_frame(FLAG_WITH_SELF, self.chunk_samples, state.sequence, state.last_timestamp,
+                                 without_self, with_self)
+        state.sequence += 1
+        self.send_audio(room_name, client, message)
+
+    def forward_audio(self, room_name: str, sender: Socket, frame: AudioFrame):
+        # tag the frame with its speaker and codec and queue it for the rest of the room,
+        # and for the speaker too while it records, like the mix with self
+        state = self.audio_clients[sender]
+        message = pack_forwarded(frame, state.id, state.codec.id)
+        for client in self.rooms[room_name]:
+            if client is not sender or state.want_self:
+                self.send_audio(room_name, client, message)
+
+    def set_room_mode(self, room_name: str, mode: str):
+        if self.room_modes[room_name] == mode:
+            return
+        self.room_modes[room_name] = mode
+        # the audio buffered for the mixer is stale in either direction
+        for buffer in self.audio_buffers[room_name].values():
+            buffer.reset()
+        self.resize_outboxes(room_name)
+        # wake up the mixer, it goes back to sleep in forward mode
+        self.audio_arrivals[room_name].set()
+        print(f"Room {room_name} switched to {mode} mode.")
+
+    def resize_outboxes(self, room_name: str):
+        # in forward mode a listener gets one frame per speaker every tick instead of one mix
+        size = self.send_queue_size
+        if self.room_modes[room_name] == FORWARD_MODE:
+            size *= max(1, len(self.rooms[room_name]) - 1)
+        for client in self.rooms[room_name]:
+            self.audio_outboxes[client].maxsize = size
+
+    def send_audio(self, room_name: str, client: Socket, message: bytes):
+        # queue the message for the client without waiting, the oldest chunk is dropped if the client is too slow
+        if not self.audio_outboxes[client].put(message):
+            self.room_metrics[room_name].dropped_chunks.inc()
+
     def remove_client_from_mutelist(self, room_name: str, client: Socket):
+        # the client's jitter buffer was emptied when it was muted, it fills up to its target depth
+        # again before the mixer plays it, so there is no need to pad it
         self.muted_clients[room_name].remove(client)
-        # we need to ensure that the audio buffer is synchronized with others
-        # the muted client's audio buffer is empty, but others are not
-        # we need to fill the muted client's buffer with the same amount of audio chunks to keep them synchronized
-        # we can simply zero pad the muted client's buffer
-        if not all([buffer.qsize() == 0 for buffer in self.audio_buffers[room_name].values()]):
-            # get the average number of audio chunks in the non-empty buffers
-            avg_buffer_size = np.mean([buffer.qsize() for buffer in self.audio_buffers[room_name].values() if buffer.qsize() > 0])
-            avg_buffer_size = int(round(avg_buffer_size))
-            # fill the muted client's buffer with zeros
-            for _ in range(avg_buffer_size):
-                self.audio_buffers[room_name][client].put_nowait(b'\x00' * self.audio_chunk_size)
 
     def mix_audio(self, audio_chunks: Dict[Socket, List[bytes]]) -> Optional[bytes]:
         if len(audio_chunks) == 0:
-            #print(f'None')
             return None
 
-        #for client in audio_chunks.keys():
-            #print(f'{client.remote_address}', end=' ')
-        #print()
-
-        # Mix the audio chunks by calculating the mean of each chunk over all clients
-        audio_chunks: List[List[bytes]] = list(audio_chunks.values())
-
-        # joint the bytes in the list
-        audio_chunks: List[bytes] = [b''.join(chunks) for chunks in audio_chunks]
-
-        # mix the byte data
-        arrays: List[np.ndarray] = [np.frombuffer(chunk, dtype=np.int16) for chunk in audio_chunks]
-        # convert to int32 to avoid overflow
-        arrays = [arr.astype(np.int32) for arr in arrays]
-        # mix the data by summing them
-        mixed_chunk = np.sum(arrays, axis=0)
-        # amplify the mixed data
-        mixed_chunk = mixed_chunk * self.amplification_factor
-        # clip the mixed data
-        mixed_chunk = np.clip(mixed_chunk, -32768, 32767)
-        # convert the mixed data back to int16
-        mixed_chunk = mixed_chunk.astype(np.int16)
-
-        return mixed_chunk.tobytes()
+        # joint the bytes of each client and mix them with the engine
+        arrays = [np.frombuffer(b''.join(chunks), dtype=np.int16) for chunks in audio_chunks.values()]
+        mixed_chunk_byte, _ = self.mix_engine.mix_chunks(arrays)
+        return mixed_chunk_byte
 
     def print_status(self):
         # print the rooms, the clients in each room, and their status
@@ -347,27 +659,42 @@ class ChatServer:
             else:
                 for client in clients:
                     print(f'\tClient: {client.remote_address}', end='; ')
-                    print(f'Audio buffer size: {self.audio_buffers[room_name][client].qsize()}', end='; ')
+                    print(f'Audio buffer size: {len(self.audio_buffers[room_name][client]) // self.chunk_samples}', end='; ')
                     if client in self.muted_clients[room_name]:
                         print(' (muted)')
                     else:
                         print()
 
     async def run(self, host, port):
+        self.audio_port = port
         async with websockets.serve(self.handler, host, port):
             print(f"Server started at ws://{host}:{port}")
             await asyncio.Future()  # run forever
 
     async def run2(self, host, port):
+        self.video_port = port
         async with websockets.serve(self.handler2, host, port):
             print(f"Server started at ws://{host}:{port}")
             await asyncio.Future()
 
 async def main():
+    if config['workers'] > 1:
+        # the supervisor keeps the room registry and the rooms are served by worker processes
+        await RoomRouter(config).run(config['ip'], config['port'])
+        return
+
     server = ChatServer(config)
-    audio_server_task = asyncio.create_task(server.run(config['ip'], config['port']))
-    video_server_task = asyncio.create_task(server.run2(config['ip'], config['port'] + 1))
-    await asyncio.gather(audio_server_task, video_server_task)
+    tasks = [
+        asyncio.create_task(server.run(config['ip'], config['port'])),
+        asyncio.create_task(server.run2(config['ip'], config['port'] + 1)),
+    ]
+    if config['metrics_port'] is not None:
+        # the metrics are only served locally
+        tasks.append(asyncio.create_task(server.metrics.serve('127.0.0.1', config['metrics_port'])))
+    if config['metrics_snapshot_path'] is not None:
+        tasks.append(asyncio.create_task(server.metrics.write_snapshots(
+            config['metrics_snapshot_path'], config['metrics_snapshot_interval'])))
+    await asyncio.gather(*tasks)
 
 if __name__ == "__main__":
     # server = ChatServer(config)
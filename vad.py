@@ -0,0 +1,45 @@
+import numpy as np
+
+
+class VoiceActivityDetector:
+    """
+    Energy and zero-crossing voice activity detector. A chunk is split into short sub-frames that are
+    analysed in one vectorized pass, and it is speech if any sub-frame is well above the noise floor,
+    or a bit above it with the many zero crossings of a fricative. The noise floor follows the quietest
+    sub-frames, and a hangover keeps the tail of words from being cut.
+    """
+    def __init__(self, chunk_samples: int, sub_frames: int = 8, margin_db: float = 12.0, hangover: int = 6,
+                 min_level_db: float = -55.0):
+        self.sub_frames = sub_frames
+        self.sub_frame_samples = chunk_samples // sub_frames
+        # dB above the noise floor for a sub-frame to be speech
+        self.margin_db = margin_db
+        # number of chunks still sent as speech after the last speech chunk
+        self.hangover = hangover
+        # sub-frames quieter than this are never speech, whatever the noise floor
+        self.min_level_db = min_level_db
+        self.noise_db = -60.0
+        self.silent_chunks = hangover
+
+    def is_speech(self, samples: np.ndarray) -> bool:
+        n = self.sub_frames * self.sub_frame_samples
+        frames = samples[:n].astype(np.float32).reshape(self.sub_frames, self.sub_frame_samples)
+        power = np.mean(np.square(frames), axis=1)
+        energy_db = 10 * np.log10(power / 32768.0 ** 2 + 1e-12)
+        signs = np.signbit(frames)
+        zcr = np.count_nonzero(signs[:, 1:] != signs[:, :-1], axis=1) / self.sub_frame_samples
+
+        loud = energy_db > max(self.noise_db + self.margin_db, self.min_level_db)
+        fricative = (energy_db > max(self.noise_db + self.margin_db / 2, self.min_level_db)) & (zcr > 0.25)
+        # the floor drops at once to the quietest sub-frame and rises slowly, about 2 dB/s, so it
+        # also follows a noise that gets louder
+        self.noise_db = min(self.noise_db + 0.1, float(energy_db.min()))
+
+        if np.any(loud | fricative):
+            self.silent_chunks = 0
+            return True
+        self.silent_chunks += 1
+        return self.silent_chunks <= self.hangover
+
+    def reset(self):
+        self.silent_chunks = self.hangover
@@ -0,0 +1,377 @@
+import math
+import threading
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+import cv2
+import numpy as np
+from PIL import Image
+
+from protocol import KEYFRAME, PATCH, PATCH_HEADER
+
+
+class VideoQualityController:
+    """
+    Picks the JPEG quality, frame rate and resolution of the video we send from the congestion
+    feedback of the server and the backlog of our own uplink. A single level between 0 and 1 is
+    raised slowly while everyone keeps up and cut quickly when someone does not (AIMD). The top
+    third of the level sets the quality, the middle third the frame rate and the bottom third the
+    resolution, so the picture first gets blurrier, then choppier and only then smaller. The level
+    is cut at most once per feedback interval, the time a cut takes to show in the feedback.
+    """
+    def __init__(self, config):
+        self.width = config["video_width"]
+        self.height = config["video_height"]
+        self.min_quality = config["video_min_quality"]
+        self.max_quality = config["video_max_quality"]
+        self.min_fps = config["video_min_fps"]
+        self.max_fps = config["video_max_fps"]
+        self.min_scale = config["video_min_scale"]
+        # fraction of our frames a receiver may lose to newer ones before we back off
+        self.max_replaced = 0.1
+        self.increase = 0.05
+        self.decrease = 0.7
+        self.cut_interval = config["video_feedback_interval"]
+        self.last_cut = None
+        self.level = 1.0
+
+    def stage(self, index: int) -> float:
+        # how far the level is into its third number index, from 0 to 1
+        return min(1.0, max(0.0, self.level * 3 - index))
+
+    @property
+    def quality(self) -> int:
+        return int(round(self.min_quality + (self.max_quality - self.min_quality) * self.stage(2)))
+
+    @property
+    def fps(self) -> float:
+        return self.min_fps + (self.max_fps - self.min_fps) * self.stage(1)
+
+    @property
+    def size(self) -> Tuple[int, int]:
+        scale = self.min_scale + (1 - self.min_scale) * self.stage(0)
+        # even sizes keep the JPEG chroma subsampling aligned
+        return int(self.width * scale) // 2 * 2, int(self.height * scale) // 2 * 2
+
+    def congested(self):
+        now = time.monotonic()
+        if self.last_cut is not None and now - self.last_cut < self.cut_interval:
+            # the previous cut has not had time to take effect
+            return
+        self.last_cut = now
+        self.level *= self.decrease
+
+    def on_feedback(self, report: Dict):
+        # report of the server about our receivers since the previous one
+        if report["receivers"] == 0:
+            return
+        if report["worst_replaced"] > self.max_replaced or report["depth"] > 1:
+            self.congested()
+        else:
+            self.level = min(1.0, self.level + self.increase)
+
+    def on_uplink_backlog(self):
+        # the previous frame is still waiting in our socket, the uplink is shared with the audio
+        self.congested()
+
+
+class FrameGrabber:
+    """
+    Reads the camera in its own thread and keeps only the newest frame, so the event loop never waits
+    on the camera and the encoder never gets a frame older than the latest one.
+    """
+    def __init__(self, capture):
+        self.capture = capture
+        self.lock = threading.Lock()
+        self.frame: Optional[np.ndarray] = None
+        self.running = False
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def start(self):
+        self.running = True
+        self.thread.start()
+
+    def run(self):
+        # read blocks until the camera has a new frame, so this loop follows the camera rate
+        while self.running:
+            ret, frame = self.capture.read()
+            if not ret:
+                self.running = False
+                break
+            with self.lock:
+                self.frame = frame
+
+    def take(self) -> Optional[np.ndarray]:
+        # the newest frame, or None if there is none since the previous call
+        with self.lock:
+            frame, self.frame = self.frame, None
+        return frame
+
+    def stop(self):
+        self.running = False
+
+
+class FrameDiffer:
+    """
+    Decides what to send of each frame from a cheap difference of downsampled frames. A frame with no
+    tile different from the last one sent is skipped. Otherwise only the bounding box of the tiles
+    that differ from the latest keyframe is sent, so every patch is complete on its own and a receiver
+    that missed some patches only needs the keyframe and the newest patch. A keyframe is sent every
+    keyframe_interval seconds, so that late joiners sync, and whenever a patch would cover most of the frame.
+    """
+    def __init__(self, tile: int = 16, step: int = 4, threshold: float = 6.0, keyframe_interval: float = 2.0,
+                 max_patch_fraction: float = 0.5):
+        # tiles are tile pixels wide, aligned on the 16 pixel blocks of JPEG, and compared on every step-th pixel
+        self.tile = tile
+        self.step = step
+        self.cells = tile // step
+        # mean difference of the sum of the three channels above which a tile has changed
+        self.threshold = 3 * threshold
+        self.keyframe_interval = keyframe_interval
+        self.max_patch_fraction = max_patch_fraction
+        self.keyframe_small: Optional[np.ndarray] = None
+        self.sent_small: Optional[np.ndarray] = None
+        self.keyframe_time = 0.0
+
+    def downsample(self, frame: np.ndarray) -> np.ndarray:
+        small = frame[::self.step, ::self.step].astype(np.int16).sum(axis=2)
+        # pad to whole tiles, the padding never differs
+        rows = -(-small.shape[0] // self.cells) * self.cells
+        columns = -(-small.shape[1] // self.cells) * self.cells
+        return np.pad(small, ((0, rows - small.shape[0]), (0, columns - small.shape[1])))
+
+    def changed(self, small: np.ndarray, reference: np.ndarray) -> np.ndarray:
+        # mask of the tiles whose mean difference is above the threshold
+        diff = np.abs(small - reference)
+        rows, columns = diff.shape[0] // self.cells, diff.shape[1] // self.cells
+        return diff.reshape(rows, self.cells, columns, self.cells).mean(axis=(1, 3)) > self.threshold
+
+    def plan(self, frame: np.ndarray, now: float) -> Tuple[Optional[bytes], Optional[Tuple[int, int, int, int]]]:
+        # the kind of payload to send for the frame, None to skip it, and the x, y, width, height of a patch
+        small = self.downsample(frame)
+        keyframe = (self.keyframe_small is None or small.shape != self.keyframe_small.shape
+                    or now - self.keyframe_time >= self.keyframe_interval)
+        if not keyframe:
+            if not self.changed(small, self.sent_small).any():
+                return None, None
+            changed = self.changed(small, self.keyframe_small)
+            # back to the keyframe, or too different from it for a patch to pay off
+            keyframe = not changed.any() or changed.mean() > self.max_patch_fraction
+        if keyframe:
+            self.keyframe_small = small
+            self.sent_small = small
+            self.keyframe_time = now
+            return KEYFRAME, None
+
+        self.sent_small = small
+        rows, columns = np.nonzero(changed)
+        y, x = int(rows.min()) * self.tile, int(columns.min()) * self.tile
+        height = min(frame.shape[0], (int(rows.max()) + 1) * self.tile) - y
+        width = min(frame.shape[1], (int(columns.max()) + 1) * self.tile) - x
+        return PATCH, (x, y, width, height)
+
+
+def encode_frame(frame: np.ndarray, display_size: Tuple[int, int], size: Tuple[int, int], quality: int,
+                 differ: FrameDiffer, now: float) -> Tuple[np.ndarray, Optional[bytes]]:
+    # resize a camera frame for our own preview and encode what changed in it as JPEG at the given size
+    # and quality, None if nothing changed, runs in the encode worker, the preview is returned in RGB for the GUI
+    preview = cv2.resize(frame, display_size)
+    scaled = preview if size == display_size else cv2.resize(preview, size, interpolation=cv2.INTER_AREA)
+    kind, region = differ.plan(scaled, now)
+    preview = cv2.cvtColor(preview, cv2.COLOR_BGR2RGB)
+    if kind is None:
+        return preview, None
+    if kind == KEYFRAME:
+        _, buffer = cv2.imencode('.jpg', scaled, [cv2.IMWRITE_JPEG_QUALITY, quality])
+        return preview, KEYFRAME + buffer.tobytes()
+    x, y, width, height = region
+    _, buffer = cv2.imencode('.jpg', scaled[y:y + height, x:x + width], [cv2.IMWRITE_JPEG_QUALITY, quality])
+    return preview, PATCH + PATCH_HEADER.pack(x, y) + buffer.tobytes()
+
+
+class PeerFrames:
+    """
+    Latest decoded frame of every peer, written by the decode workers and read by the GUI at its
+    own rate. While a frame of a peer is being decoded, newer frames of the same peer are coalesced:
+    only the newest keyframe and the newest patch after it are decoded next, so neither the workers
+    nor the GUI fall behind. Patches are pasted into a copy of the latest keyframe of the peer.
+    """
+    def __init__(self, executor, display_size: Tuple[int, int]):
+        self.executor = executor
+        self.display_size = display_size
+        self.lock = threading.Lock()
+        # peer -> latest RGB frame not shown yet
+        self.frames: Dict = {}
+        # peer -> newest encoded frames waiting for the decoding of the previous one
+        self.pending: Dict[Any, List] = {}
+        self.decoding = set()
+        # peer -> latest decoded keyframe, in BGR at the size it was sent, only used by the decode workers
+        self.keyframes: Dict = {}
+        # peers that left since the GUI last looked
+        self.left = set()
+        # peer -> number of times it left, a decode started before the peer left stores nothing
+        self.generations: Dict = {}
+
+    def submit(self, peer, data):
+        # decode a payload of a peer in the worker pool, called on the event loop
+        with self.lock:
+            self.left.discard(peer)
+            if peer in self.decoding:
+                waiting = self.pending.get(peer)
+                if data[0:1] == PATCH and waiting and waiting[0][0:1] == KEYFRAME:
+                    # the patch applies to the waiting keyframe
+                    self.pending[peer] = [waiting[0], data]
+                else:
+                    self.pending[peer] = [data]
+                return
+            self.decoding.add(peer)
+            generation = self.generations.get(peer, 0)
+        self.executor.submit(self.decode, peer, generation, [data])
+
+    def decode(self, peer, generation: int, batch: List):
+        # runs in the executor, whose future nobody looks at, so errors are printed here
+        try:
+            while batch:
+                frame = None
+                try:
+                    for data in batch:
+                        frame = self.decode_payload(peer, generation, data)
+                    if frame is not None:
+                        if (frame.shape[1], frame.shape[0]) != self.display_size:
+                            # the sender lowered its resolution, keep the same size on screen
+                            frame = cv2.resize(frame, self.display_size)
+                        frame = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
+                except Exception as e:
+                    # a bad payload only costs its frame
+                    print(f"Failed to decode a video frame of {peer}: {e}")
+                    frame = None
+                with self.lock:
+                    if self.generations.get(peer, 0) != generation:
+                        # the peer left during the decoding, what is pending now is for its next visit
+                        batch = None
+                        break
+                    if frame is not None:
+                        self.frames[peer] = frame
+                    batch = self.pending.pop(peer, None)
+                    if batch is None:
+                        self.decoding.discard(peer)
+        finally:
+            if batch is not None:
+                # left the loop on an error, the next frame of the peer starts decoding again
+                with self.lock:
+                    if self.generations.get(peer, 0) == generation:
+                        self.pending.pop(peer, None)
+                        self.decoding.discard(peer)
+
+    def decode_payload(self, peer, generation: int, data) -> Optional[np.ndarray]:
+        # the BGR frame a payload makes at the size it was sent, None if it cannot be shown
+        kind = data[0:1]
+        if kind == KEYFRAME:
+            frame = cv2.imdecode(np.frombuffer(data[1:], np.uint8), cv2.IMREAD_COLOR)
+            if frame is not None:
+                with self.lock:
+                    if self.generations.get(peer, 0) == generation:
+                        self.keyframes[peer] = frame
+            return frame
+        keyframe = self.keyframes.get(peer)
+        if kind != PATCH or keyframe is None:
+            # we joined after the keyframe, the server sends it to us when we join, so this is rare
+            return None
+        x, y = PATCH_HEADER.unpack_from(data, 1)
+        region = cv2.imdecode(np.frombuffer(data[1 + PATCH_HEADER.size:], np.uint8), cv2.IMREAD_COLOR)
+        if region is None:
+            return None
+        frame = keyframe.copy()
+        frame[y:y + region.shape[0], x:x + region.shape[1]] = region[:frame.shape[0] - y, :frame.shape[1] - x]
+        return frame
+
+    def put(self, peer, frame: np.ndarray):
+        # an RGB frame that is already decoded, our own preview
+        with self.lock:
+            self.frames[peer] = frame
+
+    def remove(self, peer):
+        with self.lock:
+            self.frames.pop(peer, None)
+            self.pending.pop(peer, None)
+            self.keyframes.pop(peer, None)
+            self.left.add(peer)
+            # a decode still running for the peer is dropped, the next frame starts a new one
+            self.decoding.discard(peer)
+            self.generations[peer] = self.generations.get(peer, 0) + 1
+
+    def take(self):
+        # the frames to show and the peers to hide since the previous call
+        with self.lock:
+            frames, self.frames = self.frames, {}
+            left, self.left = self.left, set()
+        return frames, left
+
+    def clear(self):
+        with self.lock:
+            self.frames = {}
+            self.pending = {}
+            self.keyframes = {}
+            self.left = set()
+            for peer in self.decoding:
+                self.generations[peer] = self.generations.get(peer, 0) + 1
+            self.decoding = set()
+
+
+class VideoGallery:
+    """
+    Composites the video tiles of all the peers, and our own camera first, into one preallocated RGB
+    canvas laid out as a near-square grid. The GUI shows the canvas through a single persistent image,
+    so a new frame costs one copy into its tile and nothing is allocated unless the grid changes.
+    """
+    def __init__(self, tile_size: Tuple[int, int]):
+        self.tile_width, self.tile_height = tile_size
+        # keys of the tiles in grid order
+        self.keys: List = []
+        self.columns = 1
+        self.canvas = np.zeros((self.tile_height, self.tile_width, 3), dtype=np.uint8)
+        # True if the canvas changed since it was last shown
+        self.dirty = False
+
+    def tile(self, index: int) -> np.ndarray:
+        # view of the canvas under tile number index
+        row, column = divmod(index, self.columns)
+        return self.canvas[row * self.tile_height:(row + 1) * self.tile_height,
+                           column * self.tile_width:(column + 1) * self.tile_width]
+
+    def layout(self, keys: List):
+        # rebuild the grid for new keys, moving the pixels of the tiles that stay
+        old = [(key, self.tile(index).copy()) for index, key in enumerate(self.keys) if key in keys]
+        self.keys = keys
+        count = max(1, len(keys))
+        self.columns = math.ceil(math.sqrt(count))
+        rows = math.ceil(count / self.columns)
+        shape = (rows * self.tile_height, self.columns * self.tile_width, 3)
+        if self.canvas.shape != shape:
+            self.canvas = np.zeros(shape, dtype=np.uint8)
+        else:
+            self.canvas.fill(0)
+        for key, pixels in old:
+            self.tile(keys.index(key))[:] = pixels
+        self.dirty = True
+
+    def draw(self, key, frame: np.ndarray):
+        # copy an RGB frame of the tile size into the tile of key, added if new
+        if key not in self.keys:
+            # our own camera, key None, always comes first
+            self.layout([key] + self.keys if key is None else self.keys + [key])
+        self.tile(self.keys.index(key))[:] = frame
+        self.dirty = True
+
+    def remove(self, key):
+        if key in self.keys:
+            self.layout([k for k in self.keys if k != key])
+
+    def clear(self):
+        self.layout([])
+
+    def image(self) -> Image.Image:
+        # the canvas as a PIL image sharing its memory
+        self.dirty = False
+        height, width, _ = self.canvas.shape
+        return Image.frombuffer('RGB', (width, height), self.canvas, 'raw', 'RGB', 0, 1)